@@ -4,30 +4,743 @@ Simple HTTP API for text-to-speech synthesis
 """
 import os
 import io
-import wave
-from flask import Flask, request, Response, jsonify
+import json
+import re
+import time
+import uuid
+import struct
+import hashlib
+import shutil
+import zipfile
+import threading
+import subprocess
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, request, Response, g, jsonify, stream_with_context
 from flask_cors import CORS
 from piper import PiperVoice
 
 app = Flask(__name__)
 CORS(app)
 
-# Load voice model
+# Voice models
 VOICE_PATH = os.environ.get('PIPER_VOICE', '/app/voices/en_US-amy-medium.onnx')
-voice = None
+VOICES_DIR = os.environ.get('PIPER_VOICES_DIR', '/app/voices')
+DEFAULT_VOICE = os.path.basename(VOICE_PATH)[:-len('.onnx')] if VOICE_PATH.endswith('.onnx') else os.path.basename(VOICE_PATH)
 
-def get_voice():
-    global voice
-    if voice is None:
-        print(f"Loading voice model: {VOICE_PATH}")
-        voice = PiperVoice.load(VOICE_PATH)
-        print("Voice model loaded!")
-    return voice
+# Resident voice limits: count and (approximate, by .onnx size) memory
+MAX_VOICES = int(os.environ.get('PIPER_MAX_VOICES', '3'))
+MAX_VOICE_MB = float(os.environ.get('PIPER_MAX_VOICE_MB', '0'))  # 0 = no memory cap
+
+# Synthesis workers and admission control. ONNX Runtime releases the GIL
+# while running, so worker threads synthesize on separate cores in parallel.
+WORKERS = int(os.environ.get('PIPER_WORKERS', str(os.cpu_count() or 1)))
+QUEUE_DEPTH = int(os.environ.get('PIPER_QUEUE_DEPTH', str(WORKERS * 4)))
+# ONNX threads per inference; keeps workers from oversubscribing the cores
+SESSION_THREADS = int(os.environ.get('PIPER_SESSION_THREADS', str(max(1, (os.cpu_count() or 1) // WORKERS))))
+
+# Sentences of one request synthesized ahead of the one being sent
+PIPELINE_LOOKAHEAD = int(os.environ.get('PIPER_PIPELINE_LOOKAHEAD', str(WORKERS)))
+# Text goes to the phonemizer in chunks of at least this many characters
+PHONEMIZE_CHUNK_CHARS = int(os.environ.get('PIPER_PHONEMIZE_CHUNK_CHARS', '300'))
+
+# Most utterances accepted by one /api/tts/batch request
+BATCH_MAX_ITEMS = int(os.environ.get('PIPER_BATCH_MAX_ITEMS', '64'))
+
+class VoiceNotFound(Exception):
+    pass
+
+class VoicePool:
+    """
+    Loaded PiperVoice instances by name. Voices are loaded on first use and
+    the least recently used ones are unloaded once more than max_voices (or
+    more than max_bytes of model files) are resident.
+    """
+    
+    def __init__(self, max_voices, max_bytes=0):
+        self.max_voices = max(1, max_voices)
+        self.max_bytes = max_bytes
+        self.voices = OrderedDict()  # name -> (voice, model bytes)
+        self.lock = threading.Lock()
+        self.load_locks = {}  # name -> lock, so each voice is only loaded once
+    
+    def resolve(self, name=None):
+        """Map a voice name to its model path"""
+        if not name or name == DEFAULT_VOICE:
+            return DEFAULT_VOICE, VOICE_PATH
+        name = os.path.basename(name)
+        if name.endswith('.onnx'):
+            name = name[:-len('.onnx')]
+        path = os.path.join(VOICES_DIR, name + '.onnx')
+        if not os.path.isfile(path):
+            raise VoiceNotFound(f"Unknown voice: {name}")
+        return name, path
+    
+    def get(self, name=None):
+        """Return (name, PiperVoice), loading the voice if needed"""
+        name, path = self.resolve(name)
+        
+        with self.lock:
+            if name in self.voices:
+                self.voices.move_to_end(name)
+                return name, self.voices[name][0]
+            load_lock = self.load_locks.setdefault(name, threading.Lock())
+        
+        with load_lock:
+            with self.lock:
+                if name in self.voices:
+                    self.voices.move_to_end(name)
+                    return name, self.voices[name][0]
+            
+            print(f"Loading voice model: {path}")
+            start = time.perf_counter()
+            v = PiperVoice.load(path)
+            limit_session_threads(v, path)
+            metrics.observe_voice_load(name, time.perf_counter() - start)
+            print("Voice model loaded!")
+            
+            with self.lock:
+                self.voices[name] = (v, os.path.getsize(path))
+                self._evict()
+        return name, v
+    
+    def _evict(self):
+        """Unload least recently used voices over the limits (lock held)"""
+        while len(self.voices) > 1:
+            total = sum(size for _, size in self.voices.values())
+            over_bytes = self.max_bytes and total > self.max_bytes
+            if len(self.voices) <= self.max_voices and not over_bytes:
+                break
+            name, _ = self.voices.popitem(last=False)
+            print(f"Unloaded voice model: {name}")
+    
+    def loaded(self):
+        with self.lock:
+            return list(self.voices)
+
+def limit_session_threads(v, path):
+    """Recreate the voice's ONNX session with SESSION_THREADS intra-op threads"""
+    try:
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = SESSION_THREADS
+        options.inter_op_num_threads = 1
+        v.session = onnxruntime.InferenceSession(
+            path,
+            sess_options=options,
+            providers=v.session.get_providers()
+        )
+    except Exception as e:
+        print(f"Keeping default ONNX session options: {e}")
+
+voice_pool = VoicePool(MAX_VOICES, int(MAX_VOICE_MB * 1024 * 1024))
+
+class Admission:
+    """
+    Counts requests that are synthesizing or waiting for a worker and
+    rejects new ones once `limit` are in the system
+    """
+    
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+    
+    def try_enter(self):
+        with self.lock:
+            if self.active >= self.limit:
+                self.rejected += 1
+                return False
+            self.active += 1
+            return True
+    
+    def leave(self):
+        with self.lock:
+            self.active -= 1
+
+executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix='piper-synth')
+# espeak-ng is not reentrant, so all phonemization runs on one thread
+phonemizer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='piper-phonemize')
+admission = Admission(WORKERS + QUEUE_DEPTH)
+
+def overloaded():
+    """503 response for load shedding"""
+    response = jsonify({"error": "TTS server is busy, try again shortly"})
+    response.status_code = 503
+    response.headers['Retry-After'] = '1'
+    return response
+
+def get_voice(name=None):
+    """Return (name, PiperVoice) for a voice name (default: PIPER_VOICE)"""
+    return voice_pool.get(name)
+
+# Histogram buckets (seconds)
+SENTENCE_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+REQUEST_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Histogram:
+    """Cumulative-bucket histogram per label value, Prometheus style"""
+    
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.series = {}  # label -> [bucket counts..., count, sum]
+    
+    def observe(self, label, value):
+        series = self.series.setdefault(label, [0] * len(self.buckets) + [0, 0.0])
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += 1
+        series[-1] += value
+    
+    def render(self, name, label_name):
+        lines = []
+        for label, series in sorted(self.series.items()):
+            for bound, count in zip(self.buckets, series):
+                lines.append(f'{name}_bucket{{{label_name}="{label}",le="{bound}"}} {count}')
+            lines.append(f'{name}_bucket{{{label_name}="{label}",le="+Inf"}} {series[-2]}')
+            lines.append(f'{name}_count{{{label_name}="{label}"}} {series[-2]}')
+            lines.append(f'{name}_sum{{{label_name}="{label}"}} {series[-1]:.6f}')
+        return lines
+
+class Metrics:
+    """
+    Counters and latency histograms for /metrics. Everything is updated
+    under one lock; none of it is on a path hot enough for that to matter.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}  # (endpoint, status) -> count
+        self.request_seconds = Histogram(REQUEST_BUCKETS)  # by endpoint, until the response is closed
+        self.synthesis_seconds = Histogram(REQUEST_BUCKETS)  # by endpoint, text in to audio out
+        self.sentence_seconds = Histogram(SENTENCE_BUCKETS)  # by voice, one ONNX inference
+        self.characters = 0
+        self.synthesis_total = 0.0  # wall seconds spent in synthesis_seconds
+        self.audio_seconds = 0.0  # audio produced by inference (cache misses)
+        self.compute_seconds = 0.0  # inference time for that audio
+        self.voice_loads = {}  # voice -> (load count, last load seconds)
+    
+    def observe_request(self, endpoint, status, seconds):
+        with self.lock:
+            key = (endpoint, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.request_seconds.observe(endpoint, seconds)
+    
+    def observe_synthesis(self, endpoint, characters, seconds):
+        with self.lock:
+            self.characters += characters
+            self.synthesis_total += seconds
+            self.synthesis_seconds.observe(endpoint, seconds)
+    
+    def observe_sentence(self, voice_id, audio_seconds, seconds):
+        with self.lock:
+            self.audio_seconds += audio_seconds
+            self.compute_seconds += seconds
+            self.sentence_seconds.observe(voice_id, seconds)
+    
+    def observe_voice_load(self, voice_id, seconds):
+        with self.lock:
+            count, _ = self.voice_loads.get(voice_id, (0, 0.0))
+            self.voice_loads[voice_id] = (count + 1, seconds)
+    
+    def render(self):
+        """Prometheus text exposition format"""
+        def metric(name, kind, help_text, samples):
+            out = [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            out += samples if isinstance(samples, list) else [f"{name} {samples}"]
+            return out
+        
+        with self.lock:
+            lines = []
+            lines += metric("piper_requests_total", "counter", "HTTP requests by endpoint and status", [
+                f'piper_requests_total{{endpoint="{e}",status="{s}"}} {n}'
+                for (e, s), n in sorted(self.requests.items())
+            ])
+            lines += metric("piper_request_duration_seconds", "histogram",
+                            "Time until the response was fully sent",
+                            self.request_seconds.render("piper_request_duration_seconds", "endpoint"))
+            lines += metric("piper_synthesis_duration_seconds", "histogram",
+                            "Time from text to finished audio per TTS request",
+                            self.synthesis_seconds.render("piper_synthesis_duration_seconds", "endpoint"))
+            lines += metric("piper_sentence_inference_seconds", "histogram",
+                            "ONNX inference time per synthesized sentence",
+                            self.sentence_seconds.render("piper_sentence_inference_seconds", "voice"))
+            lines += metric("piper_characters_total", "counter", "Characters of text received for synthesis", self.characters)
+            lines += metric("piper_characters_per_second", "gauge", "Characters per second of synthesis time",
+                            round(self.characters / self.synthesis_total, 3) if self.synthesis_total else 0)
+            lines += metric("piper_audio_seconds_total", "counter", "Seconds of audio produced by inference", round(self.audio_seconds, 6))
+            lines += metric("piper_inference_seconds_total", "counter", "Seconds spent in inference", round(self.compute_seconds, 6))
+            lines += metric("piper_real_time_factor", "gauge", "Audio seconds per inference second",
+                            round(self.audio_seconds / self.compute_seconds, 3) if self.compute_seconds else 0)
+            lines += metric("piper_voice_loads_total", "counter", "Voice model loads", [
+                f'piper_voice_loads_total{{voice="{v}"}} {count}'
+                for v, (count, _) in sorted(self.voice_loads.items())
+            ])
+            lines += metric("piper_voice_load_seconds", "gauge", "Duration of the last load of each voice", [
+                f'piper_voice_load_seconds{{voice="{v}"}} {seconds:.6f}'
+                for v, (_, seconds) in sorted(self.voice_loads.items())
+            ])
+        
+        lines += metric("piper_voices_loaded", "gauge", "Voice models currently loaded", len(voice_pool.loaded()))
+        lines += metric("piper_workers", "gauge", "Synthesis worker threads", WORKERS)
+        lines += metric("piper_active_requests", "gauge", "Requests synthesizing or waiting for a worker", admission.active)
+        lines += metric("piper_max_requests", "gauge", "Admission limit", admission.limit)
+        lines += metric("piper_rejected_requests_total", "counter", "Requests shed with 503", admission.rejected)
+        lines += metric("piper_queued_sentences", "gauge", "Sentences waiting for a synthesis worker",
+                        executor._work_queue.qsize())
+        
+        stats = audio_cache.stats()
+        lines += metric("piper_cache_hits_total", "counter", "Audio cache hits (memory and disk)", stats["hits"])
+        lines += metric("piper_cache_disk_hits_total", "counter", "Audio cache hits served from disk", stats["disk_hits"])
+        lines += metric("piper_cache_misses_total", "counter", "Audio cache misses", stats["misses"])
+        lines += metric("piper_cache_evictions_total", "counter", "Audio cache memory evictions", stats["evictions"])
+        lines += metric("piper_cache_entries", "gauge", "Sentences in the memory cache", stats["entries"])
+        lines += metric("piper_cache_bytes", "gauge", "Bytes in the memory cache", stats["bytes"])
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+def server_timing(timings):
+    """Server-Timing header value from [(name, seconds)]"""
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings)
+
+# Synthesized-audio cache (per sentence). The disk tier is off unless
+# PIPER_CACHE_DIR points at a (mounted) directory.
+CACHE_MEMORY_MB = float(os.environ.get('PIPER_CACHE_MEMORY_MB', '64'))
+CACHE_DIR = os.environ.get('PIPER_CACHE_DIR')
+CACHE_DISK_MB = float(os.environ.get('PIPER_CACHE_DISK_MB', '512'))
+
+class AudioCache:
+    """
+    Cache of synthesized PCM keyed by (voice, sentence phonemes, synthesis
+    parameters). Keying on sentences lets replies that only partly overlap
+    earlier ones still reuse audio. In-memory LRU tier bounded in bytes, plus
+    an optional disk tier with its own byte limit.
+    """
+    
+    def __init__(self, memory_bytes, disk_dir=None, disk_bytes=0):
+        self.memory_bytes = memory_bytes
+        self.disk_dir = disk_dir
+        self.disk_bytes = disk_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.disk_entries = None  # {path: size}, scanned on first write
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    @staticmethod
+    def make_key(voice_id, phonemes, params):
+        payload = json.dumps([voice_id, phonemes, params], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+    
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], key + '.pcm')
+    
+    def _store(self, key, pcm):
+        """Insert into the memory tier and evict LRU entries (lock held)"""
+        if len(pcm) > self.memory_bytes:
+            return
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key))
+        self.entries[key] = pcm
+        self.size += len(pcm)
+        while self.size > self.memory_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+    
+    def contains(self, key):
+        with self.lock:
+            if key in self.entries:
+                return True
+        return bool(self.disk_dir) and os.path.exists(self._disk_path(key))
+    
+    def get(self, key):
+        """Return cached PCM, or None on a miss"""
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+        
+        if self.disk_dir:
+            path = self._disk_path(key)
+            try:
+                with open(path, 'rb') as f:
+                    pcm = f.read()
+                os.utime(path)  # Keep disk eviction roughly LRU
+                with self.lock:
+                    self._store(key, pcm)
+                    self.hits += 1
+                    self.disk_hits += 1
+                return pcm
+            except OSError:
+                pass
+        
+        with self.lock:
+            self.misses += 1
+        return None
+    
+    def put(self, key, pcm):
+        with self.lock:
+            self._store(key, pcm)
+            if self.disk_dir:
+                self._write_disk(key, pcm)
+    
+    def _write_disk(self, key, pcm):
+        """Write one entry to disk and prune the oldest files over the limit (lock held)"""
+        try:
+            if self.disk_entries is None:
+                self.disk_entries = {}
+                for root, _, files in os.walk(self.disk_dir):
+                    for name in files:
+                        if name.endswith('.pcm'):
+                            path = os.path.join(root, name)
+                            self.disk_entries[path] = os.path.getsize(path)
+            
+            path = self._disk_path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(pcm)
+            os.replace(tmp_path, path)
+            self.disk_entries[path] = len(pcm)
+            
+            total = sum(self.disk_entries.values())
+            if total > self.disk_bytes:
+                def mtime(p):
+                    try:
+                        return os.path.getmtime(p)
+                    except OSError:
+                        return 0
+                for old_path in sorted(self.disk_entries, key=mtime):
+                    if total <= self.disk_bytes:
+                        break
+                    total -= self.disk_entries.pop(old_path)
+                    try:
+                        os.remove(old_path)
+                    except OSError:
+                        pass
+        except OSError as e:
+            print(f"TTS cache write failed: {e}")
+    
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "disk": self.disk_dir
+            }
+
+audio_cache = AudioCache(
+    int(CACHE_MEMORY_MB * 1024 * 1024),
+    CACHE_DIR,
+    int(CACHE_DISK_MB * 1024 * 1024)
+)
+
+def wav_header(sample_rate, data_size=None):
+    """
+    Header for 16-bit mono PCM WAV.
+    data_size=None is for streams of unknown length (max size, which players
+    treat as "read until the connection closes").
+    """
+    if data_size is None:
+        data_size = 0xFFFFFFFF - 36
+    return struct.pack(
+        '<4sI4s4sIHHIIHH4sI',
+        b'RIFF', 36 + data_size, b'WAVE',
+        b'fmt ', 16, 1, 1, sample_rate, sample_rate * 2, 2, 16,
+        b'data', data_size
+    )
+
+# Output encodings: container/codec arguments for ffmpeg, mimetype, extension
+AUDIO_FORMATS = {
+    "wav": {"args": ["-c:a", "pcm_s16le", "-f", "wav"], "mimetype": "audio/wav", "ext": "wav"},
+    "ogg": {"args": ["-c:a", "libopus", "-f", "ogg"], "mimetype": "audio/ogg", "ext": "ogg"},
+    "opus": {"args": ["-c:a", "libopus", "-f", "ogg"], "mimetype": "audio/ogg", "ext": "opus"},
+    "mp3": {"args": ["-c:a", "libmp3lame", "-f", "mp3"], "mimetype": "audio/mpeg", "ext": "mp3"}
+}
+DEFAULT_BITRATES = {"ogg": "32k", "opus": "32k", "mp3": "64k"}
+OPUS_SAMPLE_RATES = [8000, 12000, 16000, 24000, 48000]
+FFMPEG = shutil.which('ffmpeg')
+
+def get_output_format(data):
+    """
+    Requested output encoding
+    
+    Returns:
+        {"format", "bitrate", "sample_rate"}; format "wav" with no
+        sample_rate means plain PCM WAV without ffmpeg
+    """
+    output_format = (data.get('format') or 'wav').lower()
+    if output_format not in AUDIO_FORMATS:
+        raise ValueError(f"Unknown audio format: {output_format}")
+    
+    bitrate = data.get('bitrate') or DEFAULT_BITRATES.get(output_format)
+    if bitrate is not None:
+        bitrate = str(bitrate)
+        if bitrate.isdigit():
+            bitrate += 'k'
+        if not (bitrate[:-1].isdigit() and bitrate[-1] == 'k'):
+            raise ValueError(f"Invalid bitrate: {bitrate}")
+    
+    sample_rate = data.get('sample_rate')
+    if sample_rate not in (None, ''):
+        sample_rate = int(sample_rate)
+        if output_format in ('ogg', 'opus'):
+            # Opus only runs at a few rates; use the closest one
+            sample_rate = min(OPUS_SAMPLE_RATES, key=lambda r: abs(r - sample_rate))
+    else:
+        sample_rate = None
+    
+    if (output_format != 'wav' or sample_rate) and FFMPEG is None:
+        raise ValueError("Compressed output needs ffmpeg, which is not installed")
+    
+    return {"format": output_format, "bitrate": bitrate, "sample_rate": sample_rate}
+
+def needs_encoding(output):
+    return output["format"] != 'wav' or output["sample_rate"] is not None
+
+def ffmpeg_command(source_rate, output):
+    """ffmpeg reading raw 16-bit mono PCM on stdin and writing `output` to stdout"""
+    command = [
+        FFMPEG, '-hide_banner', '-loglevel', 'error',
+        '-f', 's16le', '-ar', str(source_rate), '-ac', '1', '-i', 'pipe:0'
+    ]
+    if output["sample_rate"]:
+        command += ['-ar', str(output["sample_rate"])]
+    elif output["format"] in ('ogg', 'opus'):
+        command += ['-ar', str(min(OPUS_SAMPLE_RATES, key=lambda r: abs(r - source_rate)))]
+    command += AUDIO_FORMATS[output["format"]]["args"]
+    if output["bitrate"] and output["format"] != 'wav':
+        command += ['-b:a', output["bitrate"]]
+    return command + ['-flush_packets', '1', 'pipe:1']
+
+def encode_audio(pcm, source_rate, output):
+    """Encode a whole PCM buffer (or wrap it as WAV when no encoding is needed)"""
+    if not needs_encoding(output):
+        return wav_header(source_rate, len(pcm)) + pcm
+    result = subprocess.run(ffmpeg_command(source_rate, output), input=pcm, capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed: {result.stderr.decode('utf-8', 'replace').strip()}")
+    return result.stdout
+
+def encode_stream(pcm_chunks, source_rate, output):
+    """
+    Encode PCM chunks on the fly. A feeder thread pipes synthesized audio into
+    ffmpeg while encoded bytes are yielded as soon as ffmpeg emits them.
+    """
+    if not needs_encoding(output):
+        yield wav_header(source_rate)
+        for chunk in pcm_chunks:
+            yield chunk
+        return
+    
+    process = subprocess.Popen(
+        ffmpeg_command(source_rate, output),
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+    )
+    
+    def feed():
+        try:
+            for chunk in pcm_chunks:
+                process.stdin.write(chunk)
+                process.stdin.flush()
+        except Exception as e:
+            print(f"TTS Error: {e}")
+        finally:
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+    
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    try:
+        while True:
+            data = process.stdout.read1(65536)
+            if not data:
+                break
+            yield data
+    finally:
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+
+def get_request_data():
+    """Get parameters from query string or JSON body"""
+    if request.method == 'POST':
+        return request.get_json(silent=True) or {}
+    return request.args
+
+def get_synthesis_params(data):
+    """Optional Piper synthesis parameters from the request"""
+    def number(name, cast):
+        value = data.get(name)
+        return cast(value) if value not in (None, '') else None
+    
+    return {
+        "speaker_id": number('speaker_id', int),
+        "length_scale": number('length_scale', float),
+        "noise_scale": number('noise_scale', float),
+        "noise_w": number('noise_w', float),
+        "sentence_silence": number('sentence_silence', float) or 0.0
+    }
+
+def describe_cache(cached, total):
+    """X-TTS-Cache value for `cached` of `total` sentences"""
+    if total and cached == total:
+        return "hit"
+    return "partial" if cached else "miss"
+
+SENTENCE_END = re.compile(r'(?<=[.!?;:…])\s+|\n\s*')
+
+def split_text(text, min_chars=PHONEMIZE_CHUNK_CHARS):
+    """
+    Split text at sentence ends into chunks of at least min_chars for the
+    phonemizer. The first sentence is a chunk of its own so the first
+    audio is not held up by phonemizing the rest.
+    """
+    chunks = []
+    current = ''
+    start = 0
+    for match in SENTENCE_END.finditer(text):
+        current += text[start:match.end()]
+        start = match.end()
+        if current.strip() and (len(current) >= min_chars or not chunks):
+            chunks.append(current)
+            current = ''
+    current += text[start:]
+    if current.strip():
+        chunks.append(current)
+    return chunks
+
+def synthesize_phonemes(v, phonemes, params):
+    """Run ONNX inference for one sentence (called on a worker thread)"""
+    return v.synthesize_ids_to_raw(
+        v.phonemes_to_ids(phonemes),
+        speaker_id=params["speaker_id"],
+        length_scale=params["length_scale"],
+        noise_scale=params["noise_scale"],
+        noise_w=params["noise_w"]
+    )
+
+def timed_synthesis(v, phonemes, params, voice_id):
+    """synthesize_phonemes() plus the compute time it took"""
+    start = time.perf_counter()
+    pcm = synthesize_phonemes(v, phonemes, params)
+    seconds = time.perf_counter() - start
+    metrics.observe_sentence(voice_id, len(pcm) / 2 / v.config.sample_rate, seconds)
+    return pcm, seconds
+
+class SentencePipeline:
+    """
+    Synthesizes one text as a pipeline: the phonemizer thread works through
+    the text chunk by chunk ahead of inference, up to `lookahead` sentences
+    are synthesized on the worker pool at once, and iterating yields the
+    PCM of each sentence in order. Cached sentences skip inference.
+    """
+    
+    def __init__(self, v, voice_id, text, params, lookahead=PIPELINE_LOOKAHEAD):
+        self.v = v
+        self.voice_id = voice_id
+        self.params = params
+        self.lookahead = max(1, lookahead)
+        self.silence = bytes(int(params["sentence_silence"] * v.config.sample_rate) * 2)
+        self.chunks = deque(phonemizer.submit(v.phonemize, chunk) for chunk in split_text(text))
+        self.sentences = self._sentences()
+        self.ahead = deque()  # phonemized (phonemes, key) not yet queued
+        self.pending = deque()  # (key, future) for misses or (None, pcm) for hits, in order
+        self.cached = 0
+        self.synthesized = 0
+        self.compute = 0.0  # Inference seconds of the sentences yielded so far
+    
+    def _sentences(self):
+        """(phonemes, key) per sentence, waiting on the phonemizer as needed"""
+        while self.chunks:
+            for phonemes in self.chunks.popleft().result():
+                yield phonemes, audio_cache.make_key(self.voice_id, "".join(phonemes), self.params)
+    
+    def _fill(self):
+        """Queue sentences until `lookahead` of them are being synthesized"""
+        in_flight = sum(1 for key, _ in self.pending if key is not None)
+        while in_flight < self.lookahead:
+            sentence = self.ahead.popleft() if self.ahead else next(self.sentences, None)
+            if sentence is None:
+                break
+            phonemes, key = sentence
+            pcm = audio_cache.get(key)
+            if pcm is None:
+                self.pending.append((key, executor.submit(timed_synthesis, self.v, phonemes, self.params, self.voice_id)))
+                self.synthesized += 1
+                in_flight += 1
+            else:
+                self.pending.append((None, pcm))
+                self.cached += 1
+    
+    def start(self):
+        """Queue the first sentences so inference starts right away"""
+        self._fill()
+        return self
+    
+    def cache_status(self, whole_text=True):
+        """
+        hit/partial/miss for the whole text (waits for phonemization to
+        finish), or only for the sentences queued so far
+        """
+        if not whole_text:
+            return describe_cache(self.cached, self.cached + self.synthesized)
+        self.ahead.extend(self.sentences)
+        cached = self.cached + sum(1 for _, key in self.ahead if audio_cache.contains(key))
+        return describe_cache(cached, self.cached + self.synthesized + len(self.ahead))
+    
+    def __iter__(self):
+        try:
+            while True:
+                self._fill()
+                if not self.pending:
+                    return
+                key, job = self.pending.popleft()
+                if key is None:
+                    pcm = job
+                else:
+                    pcm, seconds = job.result()
+                    self.compute += seconds
+                    audio_cache.put(key, pcm)
+                yield pcm + self.silence
+        finally:
+            self.close()
+    
+    def close(self):
+        """Cancel queued work, e.g. when a streaming client goes away"""
+        for key, job in self.pending:
+            if key is not None:
+                job.cancel()
+        self.pending.clear()
+        for chunk in self.chunks:
+            chunk.cancel()
 
 @app.route('/')
 def health():
     """Health check endpoint"""
-    return jsonify({"status": "ok", "service": "piper-tts"})
+    return jsonify({
+        "status": "ok",
+        "service": "piper-tts",
+        "workers": WORKERS,
+        "active_requests": admission.active,
+        "max_requests": admission.limit
+    })
 
 @app.route('/api/tts', methods=['GET', 'POST'])
 def synthesize():
@@ -35,57 +748,364 @@ def synthesize():
     Synthesize speech from text
     GET: /api/tts?text=Hello%20world
     POST: /api/tts with JSON body {"text": "Hello world"}
-    Returns: WAV audio
+    Optional: voice, speaker_id, length_scale, noise_scale, noise_w, sentence_silence,
+        format (wav/ogg/opus/mp3), bitrate (e.g. 32k), sample_rate
+    Returns: audio (WAV by default), with X-TTS-Cache: hit/partial/miss and
+    Server-Timing for voice loading, synthesis and encoding
     """
-    # Get text from query param or JSON body
-    if request.method == 'POST':
-        data = request.get_json(silent=True) or {}
-        text = data.get('text', '')
-    else:
-        text = request.args.get('text', '')
+    data = get_request_data()
+    text = data.get('text', '')
     
     if not text:
         return jsonify({"error": "No text provided"}), 400
     
     try:
-        v = get_voice()
+        params = get_synthesis_params(data)
+        output = get_output_format(data)
+    except ValueError as e:
+        return jsonify({"error": f"Invalid parameter: {e}"}), 400
+    
+    if not admission.try_enter():
+        return overloaded()
+    
+    try:
+        timings = []
+        start = mark = time.perf_counter()
         
-        # Synthesize to WAV in memory
-        wav_buffer = io.BytesIO()
-        with wave.open(wav_buffer, 'wb') as wav_file:
-            wav_file.setnchannels(1)
-            wav_file.setsampwidth(2)  # 16-bit
-            wav_file.setframerate(v.config.sample_rate)
-            
-            # Generate audio
-            for audio_bytes in v.synthesize_stream_raw(text):
-                wav_file.writeframes(audio_bytes)
+        def lap(name):
+            nonlocal mark
+            now = time.perf_counter()
+            timings.append((name, now - mark))
+            mark = now
         
-        wav_buffer.seek(0)
+        voice_name, v = get_voice(data.get('voice'))
+        lap('voice')
+        pipeline = SentencePipeline(v, voice_name, text, params)
+        pcm = b"".join(pipeline)
+        lap('synth')
+        audio = encode_audio(pcm, v.config.sample_rate, output)
+        lap('encode')
+        timings.append(('total', mark - start))
+        metrics.observe_synthesis('tts', len(text), mark - start)
+        encoding = AUDIO_FORMATS[output["format"]]
         
         return Response(
-            wav_buffer.read(),
-            mimetype='audio/wav',
-            headers={'Content-Disposition': 'inline; filename="speech.wav"'}
+            audio,
+            mimetype=encoding["mimetype"],
+            headers={
+                'Content-Disposition': f'inline; filename="speech.{encoding["ext"]}"',
+                'X-TTS-Cache': pipeline.cache_status(),
+                'Server-Timing': server_timing(timings)
+            }
         )
         
+    except VoiceNotFound as e:
+        return jsonify({"error": str(e)}), 404
     except Exception as e:
         print(f"TTS Error: {e}")
         return jsonify({"error": str(e)}), 500
+    finally:
+        admission.leave()
+
+@app.route('/api/tts/stream', methods=['GET', 'POST'])
+def synthesize_stream():
+    """
+    Stream speech while it is being synthesized
+    GET: /api/tts/stream?text=Hello%20world
+    POST: /api/tts/stream with JSON body {"text": "Hello world"}
+    Optional: same as /api/tts
+    Returns: WAV header followed by PCM chunks (chunked transfer), one
+    chunk per sentence, so playback can start after the first sentence.
+    Compressed formats are encoded on the fly as sentences arrive.
+    Server-Timing only covers the work done before the first byte
+    (voice loading and phonemizing the first chunk), and X-TTS-Cache
+    only the first sentences queued.
+    """
+    data = get_request_data()
+    text = data.get('text', '')
+    
+    if not text:
+        return jsonify({"error": "No text provided"}), 400
+    
+    try:
+        params = get_synthesis_params(data)
+        output = get_output_format(data)
+    except ValueError as e:
+        return jsonify({"error": f"Invalid parameter: {e}"}), 400
+    
+    if not admission.try_enter():
+        return overloaded()
+    
+    pipeline = None
+    try:
+        start = time.perf_counter()
+        voice_name, v = get_voice(data.get('voice'))
+        loaded = time.perf_counter()
+        # Inference of the first sentences overlaps phonemizing the rest
+        pipeline = SentencePipeline(v, voice_name, text, params).start()
+        # Only the first sentences: waiting for the whole text to be
+        # phonemized would hold back the first byte
+        cache_status = pipeline.cache_status(whole_text=False)
+        planned = time.perf_counter()
+    except VoiceNotFound as e:
+        admission.leave()
+        return jsonify({"error": str(e)}), 404
+    except Exception as e:
+        if pipeline is not None:
+            pipeline.close()
+        admission.leave()
+        print(f"TTS Error: {e}")
+        return jsonify({"error": str(e)}), 500
+    
+    def generate():
+        try:
+            for audio_bytes in encode_stream(pipeline, v.config.sample_rate, output):
+                yield audio_bytes
+            metrics.observe_synthesis('tts_stream', len(text), time.perf_counter() - start)
+        except Exception as e:
+            # Headers are already sent; all we can do is end the stream
+            print(f"TTS Error: {e}")
+    
+    encoding = AUDIO_FORMATS[output["format"]]
+    response = Response(
+        stream_with_context(generate()),
+        mimetype=encoding["mimetype"],
+        headers={
+            'Content-Disposition': f'inline; filename="speech.{encoding["ext"]}"',
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',
+            'X-TTS-Cache': cache_status,
+            'Server-Timing': server_timing([('voice', loaded - start), ('phonemize', planned - loaded)])
+        }
+    )
+    # Hold the admission slot until the stream is finished or dropped, and
+    # drop queued sentences if the client went away before reading them all
+    response.call_on_close(pipeline.close)
+    response.call_on_close(admission.leave)
+    return response
+
+@app.route('/api/tts/batch', methods=['POST'])
+def synthesize_batch():
+    """
+    Synthesize many utterances in one request, in parallel across workers
+    POST: /api/tts/batch with JSON body
+        {"items": [{"text": "Hello", "voice": "en_US-amy-medium"}, ...],
+         "package": "multipart" | "zip" | "stream"}
+    or  {"texts": ["Hello", "World"], "voice": "en_US-amy-medium"}
+    Synthesis parameters at the top level apply to every item, as do
+    format (wav/ogg/opus/mp3), bitrate and sample_rate, like on /api/tts.
+    Returns, depending on package:
+        multipart (default): multipart/mixed, one audio part per item (in
+            the requested format) with X-Item-Index, X-Voice,
+            X-Synthesis-Ms and X-TTS-Cache headers
+        zip: item-000.<ext>, item-001.<ext>, ... plus manifest.json with timings
+        stream: per item, a 4-byte big-endian length + JSON metadata, then a
+            4-byte length + the encoded audio, sent as each item is ready
+    """
+    data = request.get_json(silent=True) or {}
+    items = data.get('items')
+    if items is None:
+        texts = data.get('texts', [])
+        if not isinstance(texts, list):
+            return jsonify({"error": "texts must be a list"}), 400
+        items = [{"text": t} for t in texts]
+    package = data.get('package', 'multipart')
+    
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "No items provided"}), 400
+    if len(items) > BATCH_MAX_ITEMS:
+        return jsonify({"error": f"Too many items (max {BATCH_MAX_ITEMS})"}), 400
+    if package not in ('multipart', 'zip', 'stream'):
+        return jsonify({"error": f"Unknown package: {package}"}), 400
+    
+    try:
+        params = get_synthesis_params(data)
+        output = get_output_format(data)
+    except ValueError as e:
+        return jsonify({"error": f"Invalid parameter: {e}"}), 400
+    encoding = AUDIO_FORMATS[output["format"]]
+    
+    if not admission.try_enter():
+        return overloaded()
+    
+    # Check every item up front, then synthesize them as a pipeline: the
+    # item being sent gets the usual lookahead, the next few items one
+    # sentence each, so a batch never floods the worker queue ahead of
+    # interactive requests
+    start = time.perf_counter()
+    planned = []
+    try:
+        for index, item in enumerate(items):
+            text = item.get('text', '') if isinstance(item, dict) else ''
+            if not isinstance(text, str) or not text:
+                raise ValueError(f"Item {index} needs a non-empty text string")
+            voice_name, v = get_voice(item.get('voice') or data.get('voice'))
+            planned.append((voice_name, v, text))
+    except (ValueError, VoiceNotFound) as e:
+        admission.leave()
+        return jsonify({"error": str(e)}), 404 if isinstance(e, VoiceNotFound) else 400
+    except Exception as e:
+        admission.leave()
+        print(f"TTS Error: {e}")
+        return jsonify({"error": str(e)}), 500
+    plan_timing = [('plan', time.perf_counter() - start)]
+    
+    upcoming = iter(enumerate(planned))
+    started = deque()  # (index, voice_name, v, pipeline) in order
+    closed = False
+    
+    def start_next():
+        if closed:
+            return
+        for index, (voice_name, v, text) in upcoming:
+            started.append((index, voice_name, v, SentencePipeline(v, voice_name, text, params, lookahead=1).start()))
+            return
+    
+    def close():
+        """Cancel queued sentences, e.g. when the client goes away"""
+        nonlocal closed
+        closed = True
+        while started:
+            started.popleft()[3].close()
+    
+    def results():
+        """Yield (metadata, audio) per item, in order, as each one is ready"""
+        characters = 0
+        try:
+            for _ in range(max(1, PIPELINE_LOOKAHEAD)):
+                start_next()
+            while started:
+                index, voice_name, v, pipeline = started[0]
+                pipeline.lookahead = max(1, PIPELINE_LOOKAHEAD)
+                cache_status = pipeline.cache_status()
+                pcm = b"".join(pipeline)
+                started.popleft()
+                start_next()
+                meta = {
+                    "index": index,
+                    "voice": voice_name,
+                    "cache": cache_status,
+                    "synthesis_ms": round(pipeline.compute * 1000, 1),
+                    "ready_ms": round((time.perf_counter() - start) * 1000, 1),
+                    "audio_seconds": round(len(pcm) / 2 / v.config.sample_rate, 3)
+                }
+                audio = encode_audio(pcm, v.config.sample_rate, output)
+                meta["bytes"] = len(audio)
+                characters += len(planned[index][2])
+                yield meta, audio
+            metrics.observe_synthesis('tts_batch', characters, time.perf_counter() - start)
+        finally:
+            close()
+    
+    if package == 'zip':
+        try:
+            buffer = io.BytesIO()
+            manifest = []
+            with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as archive:
+                for meta, audio in results():
+                    meta["file"] = f"item-{meta['index']:03d}.{encoding['ext']}"
+                    archive.writestr(meta["file"], audio)
+                    manifest.append(meta)
+                archive.writestr('manifest.json', json.dumps({"items": manifest}, indent=2))
+            return Response(
+                buffer.getvalue(),
+                mimetype='application/zip',
+                headers={
+                    'Content-Disposition': 'attachment; filename="speech.zip"',
+                    'Server-Timing': server_timing(plan_timing + [('total', time.perf_counter() - start)])
+                }
+            )
+        except Exception as e:
+            print(f"TTS Error: {e}")
+            return jsonify({"error": str(e)}), 500
+        finally:
+            close()
+            admission.leave()
+    
+    if package == 'stream':
+        def generate():
+            try:
+                for meta, audio in results():
+                    header = json.dumps(meta).encode('utf-8')
+                    yield struct.pack('>I', len(header)) + header
+                    yield struct.pack('>I', len(audio)) + audio
+            except Exception as e:
+                print(f"TTS Error: {e}")
+        mimetype = 'application/octet-stream'
+    else:
+        boundary = uuid.uuid4().hex
+        mimetype = f'multipart/mixed; boundary={boundary}'
+        
+        def generate():
+            try:
+                for meta, audio in results():
+                    headers = (
+                        f"--{boundary}\r\n"
+                        f"Content-Type: {encoding['mimetype']}\r\n"
+                        f"Content-Disposition: inline; filename=\"item-{meta['index']:03d}.{encoding['ext']}\"\r\n"
+                        f"Content-Length: {len(audio)}\r\n"
+                        f"X-Item-Index: {meta['index']}\r\n"
+                        f"X-Voice: {meta['voice']}\r\n"
+                        f"X-Synthesis-Ms: {meta['synthesis_ms']}\r\n"
+                        f"X-TTS-Cache: {meta['cache']}\r\n\r\n"
+                    )
+                    yield headers.encode('utf-8') + audio + b"\r\n"
+                yield f"--{boundary}--\r\n".encode('utf-8')
+            except Exception as e:
+                print(f"TTS Error: {e}")
+    
+    response = Response(stream_with_context(generate()), mimetype=mimetype)
+    response.headers['Server-Timing'] = server_timing(plan_timing)
+    # Like /api/tts/stream: drop queued sentences if the client went away
+    response.call_on_close(close)
+    response.call_on_close(admission.leave)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Metrics in the Prometheus text format"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    """Count the request and time it until the (possibly streamed) response is closed"""
+    start = g.get('request_start')
+    if start is not None and request.endpoint != 'prometheus_metrics':
+        endpoint = request.endpoint or 'unknown'
+        status = response.status_code
+        response.call_on_close(
+            lambda: metrics.observe_request(endpoint, status, time.perf_counter() - start)
+        )
+    return response
 
 @app.route('/voices', methods=['GET'])
 def list_voices():
     """List available voices"""
-    voices_dir = '/app/voices'
     voices = []
-    if os.path.exists(voices_dir):
-        for f in os.listdir(voices_dir):
+    if os.path.exists(VOICES_DIR):
+        for f in os.listdir(VOICES_DIR):
             if f.endswith('.onnx'):
                 voices.append(f.replace('.onnx', ''))
-    return jsonify({"voices": voices})
+    return jsonify({
+        "voices": voices,
+        "default": DEFAULT_VOICE,
+        "loaded": voice_pool.loaded(),
+        "max_loaded": voice_pool.max_voices
+    })
 
 if __name__ == '__main__':
     # Pre-load voice on startup
     get_voice()
-    print("Piper TTS Server starting on port 5002...")
-    app.run(host='0.0.0.0', port=5002, threaded=True)
+    print(f"Piper TTS Server starting on port 5002 ({WORKERS} workers, queue depth {QUEUE_DEPTH})...")
+    try:
+        from waitress import serve
+        # Enough HTTP threads to hold every admitted request plus a few
+        # spare ones to answer health checks and send 503s
+        serve(app, host='0.0.0.0', port=5002, threads=WORKERS + QUEUE_DEPTH + 4)
+    except ImportError:
+        print("waitress not installed, using the Flask development server")
+        app.run(host='0.0.0.0', port=5002, threaded=True)
@@ -9,10 +9,14 @@ const readline = require('readline');
 const fs = require('fs');
 
 let pythonProcess = null;
-let messageCallback = null;
 let isReady = false;
 let currentModel = null;
 
+// Jobs sent to the Python process, by id. Every message the process sends
+// for a job carries its job_id and is routed to that job's handler.
+const jobHandlers = new Map();
+let nextJobId = 1;
+
 /**
  * Get the Python executable path (prefers local venv)
  */
@@ -82,8 +86,11 @@ function startProcess() {
                     // Missing dependencies
                     console.error('Missing Python dependencies:', data.error);
                     reject(new Error(data.error));
-                } else if (messageCallback) {
-                    messageCallback(data);
+                } else if (data.job_id && jobHandlers.has(data.job_id)) {
+                    const handler = jobHandlers.get(data.job_id);
+                    if (handler(data)) {
+                        jobHandlers.delete(data.job_id);
+                    }
                 }
             } catch (e) {
                 console.error('Failed to parse Python output:', line);
@@ -110,6 +117,7 @@ function startProcess() {
             pythonProcess = null;
             isReady = false;
             currentModel = null;
+            failPendingJobs('Image generation process exited');
         });
 
         // Timeout for startup
@@ -131,13 +139,81 @@ function sendCommand(cmd) {
     pythonProcess.stdin.write(JSON.stringify(cmd) + '\n');
 }
 
+/**
+ * Send a command that gets a job id. The handler receives every message
+ * for the job and returns true once the job is finished.
+ * @returns {string} The job id
+ */
+function submitJob(cmd, handler, jobId = null) {
+    const id = jobId || `job-${nextJobId++}`;
+    jobHandlers.set(id, handler);
+    try {
+        sendCommand({ ...cmd, id });
+    } catch (e) {
+        jobHandlers.delete(id);
+        throw e;
+    }
+    return id;
+}
+
+/**
+ * Send a job command and settle a promise on the message types in `done`
+ * (resolve) or on error/cancelled (reject)
+ */
+function runJob(cmd, { done, onProgress, timeoutMs, timeoutMessage, jobId }) {
+    let id = null;
+    const promise = new Promise((resolve, reject) => {
+        let timeout = null;
+        id = submitJob(cmd, (data) => {
+            if (data.type === 'progress') {
+                if (onProgress) onProgress(data.message, data.progress, data);
+                return false;
+            }
+            if (done.includes(data.type)) {
+                clearTimeout(timeout);
+                resolve(data);
+                return true;
+            }
+            if (data.type === 'error' || data.type === 'cancelled') {
+                clearTimeout(timeout);
+                const error = new Error(data.type === 'cancelled' ? 'Cancelled' : data.error);
+                error.cancelled = data.type === 'cancelled';
+                reject(error);
+                return true;
+            }
+            return false;
+        }, jobId);
+
+        timeout = setTimeout(() => {
+            if (jobHandlers.delete(id)) {
+                cancelJob(id);
+            }
+            reject(new Error(timeoutMessage));
+        }, timeoutMs);
+    });
+    promise.jobId = id;
+    return promise;
+}
+
+/**
+ * Reject every job that is still waiting for the Python process
+ */
+function failPendingJobs(message) {
+    for (const handler of jobHandlers.values()) {
+        handler({ type: 'error', error: message });
+    }
+    jobHandlers.clear();
+}
+
 /**
  * Load a diffusion model (from HuggingFace or local path)
  * @param {string} modelId - HuggingFace model ID or display name
  * @param {string} localPath - Optional local path to model directory
  * @param {function} onProgress - Progress callback
+ * @param {object} cpuOptions - Optional CPU mode overrides (threads,
+ *   interop_threads, bf16, compile, backend); used when running on the CPU
  */
-async function loadModel(modelId, localPath = null, onProgress = null) {
+async function loadModel(modelId, localPath = null, onProgress = null, cpuOptions = null) {
     // Handle case where localPath is actually the callback (backwards compat)
     if (typeof localPath === 'function') {
         onProgress = localPath;
@@ -146,83 +222,137 @@ async function loadModel(modelId, localPath = null, onProgress = null) {
     
     await startProcess();
     
-    return new Promise((resolve, reject) => {
-        const timeout = setTimeout(() => {
-            reject(new Error('Model loading timeout'));
-        }, 300000); // 5 min timeout for large models
+    const data = await runJob({ action: 'load', model: modelId, local_path: localPath, cpu: cpuOptions }, {
+        done: ['loaded'],
+        onProgress,
+        timeoutMs: 300000, // 5 min timeout for large models
+        timeoutMessage: 'Model loading timeout'
+    });
+    currentModel = data.model;
+    return { success: true, model: data.model, localPath: data.local_path, cpuMode: data.cpu_mode };
+}
 
-        messageCallback = (data) => {
-            if (data.type === 'progress' && onProgress) {
-                onProgress(data.message, data.progress);
-            } else if (data.type === 'loaded') {
-                clearTimeout(timeout);
-                currentModel = data.model;
-                resolve({ success: true, model: data.model, localPath: data.local_path });
-            } else if (data.type === 'error') {
-                clearTimeout(timeout);
-                reject(new Error(data.error));
-            }
-        };
+/**
+ * Generate an image. Requests are queued in the Python process; the
+ * returned promise has a `jobId` that can be passed to cancelJob().
+ * @param {object} params - prompt, negativePrompt, width, height, steps,
+ *     guidance, seed, and optionally numImages (per prompt), priority
+ *     (higher runs first) and jobId. prompt and seed may be arrays.
+ *     Encoding: format ('png', 'webp', 'jpeg'), quality, compressLevel,
+ *     lossless; output ('file' or 'base64') and keepFiles to get file
+ *     paths instead of data URLs.
+ * @returns {Promise} The result message; `images` holds every image and
+ *     `image` the first one
+ */
+function generateImage(params, onProgress) {
+    const start = isReady ? Promise.resolve() : startProcess();
+    const jobId = params.jobId || `job-${nextJobId++}`;
 
-        sendCommand({ action: 'load', model: modelId, local_path: localPath });
+    const promise = start.then(() => runJob({
+        action: 'generate',
+        prompt: params.prompt,
+        negative_prompt: params.negativePrompt || '',
+        width: params.width || 512,
+        height: params.height || 512,
+        steps: params.steps || 20,
+        guidance: params.guidance || 7.5,
+        seed: params.seed,
+        num_images: params.numImages,
+        priority: params.priority || 0,
+        // Images come back as files rather than base64 inside the JSON line
+        output: params.output || 'file',
+        format: params.format || 'png',
+        quality: params.quality,
+        compress_level: params.compressLevel,
+        lossless: params.lossless
+    }, {
+        done: ['result'],
+        onProgress: (message, progress, data) => {
+            console.log('Image gen progress:', jobId, message);
+            if (onProgress) onProgress(message, progress, data);
+        },
+        timeoutMs: 600000, // 10 min timeout for CPU generation
+        timeoutMessage: 'Image generation timeout',
+        jobId
+    })).then(async (data) => {
+        const images = await Promise.all(data.images.map((image) => readResultImage(image, params.keepFiles)));
+        return { ...data, images, image: images[0] };
     });
+    promise.jobId = jobId;
+    return promise;
 }
 
 /**
- * Generate an image
+ * Give a result image a dataUrl. Images written to files are read back
+ * (and deleted unless keepFiles is set, in which case only the path is kept).
  */
-async function generateImage(params, onProgress) {
-    if (!isReady) {
-        await startProcess();
+async function readResultImage(image, keepFiles = false) {
+    if (image.path) {
+        if (keepFiles) return image;
+        const data = await fs.promises.readFile(image.path);
+        fs.promises.unlink(image.path).catch(() => {});
+        const { path: _, ...rest } = image;
+        return { ...rest, dataUrl: `data:${image.mime_type};base64,${data.toString('base64')}` };
     }
+    return { ...image, dataUrl: `data:${image.mime_type};base64,${image.base64}` };
+}
 
-    return new Promise((resolve, reject) => {
-        const timeout = setTimeout(() => {
-            reject(new Error('Image generation timeout'));
-        }, 600000); // 10 min timeout for CPU generation
+/**
+ * Cancel a queued or running job
+ * @returns {Promise<string>} "cancelled", "cancelling" or "not_found"
+ */
+function cancelJob(jobId) {
+    if (!pythonProcess || !isReady) return Promise.resolve('not_found');
+    return new Promise((resolve) => {
+        submitJob({ action: 'cancel', job_id: jobId }, (data) => {
+            resolve(data.state || 'not_found');
+            return true;
+        });
+    });
+}
 
-        messageCallback = (data) => {
-            console.log('Image gen callback:', data.type, data.message || data.error || '');
-            if (data.type === 'progress' && onProgress) {
-                onProgress(data.message, data.progress);
-            } else if (data.type === 'result') {
-                clearTimeout(timeout);
-                resolve(data);
-            } else if (data.type === 'error') {
-                clearTimeout(timeout);
-                console.error('Image generation error:', data.error);
-                reject(new Error(data.error));
-            }
-        };
+/**
+ * Change the priority of a queued job (higher runs first)
+ */
+function setJobPriority(jobId, priority) {
+    if (!pythonProcess || !isReady) return Promise.resolve(null);
+    return new Promise((resolve) => {
+        submitJob({ action: 'set_priority', job_id: jobId, priority }, (data) => {
+            resolve(data.position ?? null);
+            return true;
+        });
+    });
+}
 
-        sendCommand({
-            action: 'generate',
-            prompt: params.prompt,
-            negative_prompt: params.negativePrompt || '',
-            width: params.width || 512,
-            height: params.height || 512,
-            steps: params.steps || 20,
-            guidance: params.guidance || 7.5,
-            seed: params.seed
+/**
+ * List the running and queued jobs
+ */
+function listJobs() {
+    if (!pythonProcess || !isReady) return Promise.resolve([]);
+    return new Promise((resolve) => {
+        submitJob({ action: 'list_jobs' }, (data) => {
+            resolve(data.jobs || []);
+            return true;
         });
     });
 }
 
 /**
- * Unload current model to free memory
+ * Unload models to free memory
+ * @param {string} model - Model id or local path to unload (default: all)
  */
-async function unloadModel() {
+async function unloadModel(model = null) {
     if (!pythonProcess || !isReady) return;
     
-    return new Promise((resolve) => {
-        messageCallback = (data) => {
-            if (data.type === 'unloaded') {
-                currentModel = null;
-                resolve({ success: true });
-            }
-        };
-        sendCommand({ action: 'unload' });
+    await runJob({ action: 'unload', model }, {
+        done: ['unloaded'],
+        timeoutMs: 60000,
+        timeoutMessage: 'Model unload timeout'
     });
+    if (!model || model === currentModel) {
+        currentModel = null;
+    }
+    return { success: true };
 }
 
 /**
@@ -332,6 +462,9 @@ module.exports = {
     startProcess,
     loadModel,
     generateImage,
+    cancelJob,
+    setJobPriority,
+    listJobs,
     unloadModel,
     getStatus,
     stopProcess,
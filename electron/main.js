@@ -895,15 +895,23 @@ ipcMain.handle('select-images', async () => {
 });
 
 // Local Image Generation via Diffusers
-ipcMain.handle('generate-image', async (event, { prompt, negativePrompt, width, height, steps, guidance, model, localPath }) => {
+ipcMain.handle('generate-image', async (event, { prompt, negativePrompt, width, height, steps, guidance, model, localPath, jobId, priority, numImages, seed }) => {
     const displayName = localPath ? path.basename(localPath) : (model || 'sdxl-turbo');
     console.log('Generating image locally:', { prompt, model: displayName, localPath: !!localPath, width, height });
 
     try {
         // Send progress updates to renderer
-        const onProgress = (message, progress) => {
+        const onProgress = (message, progress, data = {}) => {
             if (mainWindow && !mainWindow.isDestroyed()) {
-                mainWindow.webContents.send('image-gen-progress', { message, progress });
+                mainWindow.webContents.send('image-gen-progress', {
+                    message,
+                    progress,
+                    jobId: data.job_id || jobId,
+                    step: data.step,
+                    totalSteps: data.total_steps,
+                    itPerSec: data.its,
+                    eta: data.eta
+                });
             }
         };
 
@@ -923,29 +931,57 @@ ipcMain.handle('generate-image', async (event, { prompt, negativePrompt, width,
             width: width || 512,
             height: height || 512,
             steps: steps || 4, // SDXL-Turbo needs only 4 steps
-            guidance: guidance || 0.0 // SDXL-Turbo works best with 0 guidance
+            guidance: guidance || 0.0, // SDXL-Turbo works best with 0 guidance
+            seed,
+            numImages,
+            jobId,
+            priority
         }, onProgress);
 
         return {
             success: result.success,
-            image: result.image
+            image: result.image,
+            images: result.images,
+            jobId: result.job_id
         };
     } catch (error) {
+        if (error.cancelled) {
+            return { success: false, cancelled: true, error: error.message };
+        }
         console.error('Image generation error:', error);
         return { success: false, error: error.message };
     }
 });
 
+// Cancel a queued or running image generation
+ipcMain.handle('cancel-image-generation', async (event, jobId) => {
+    try {
+        const state = await getImageGen().cancelJob(jobId);
+        return { success: state !== 'not_found', state };
+    } catch (error) {
+        return { success: false, error: error.message };
+    }
+});
+
+// List queued and running image generation jobs
+ipcMain.handle('list-image-jobs', async () => {
+    try {
+        return { success: true, jobs: await getImageGen().listJobs() };
+    } catch (error) {
+        return { success: false, error: error.message };
+    }
+});
+
 // Load image generation model (supports local path)
-ipcMain.handle('load-image-model', async (event, { modelId, localPath }) => {
+ipcMain.handle('load-image-model', async (event, { modelId, localPath, cpu }) => {
     try {
         const onProgress = (message) => {
             if (mainWindow && !mainWindow.isDestroyed()) {
                 mainWindow.webContents.send('image-gen-progress', { message });
             }
         };
-        await getImageGen().loadModel(modelId, localPath, onProgress);
-        return { success: true, model: modelId, localPath };
+        const result = await getImageGen().loadModel(modelId, localPath, onProgress, cpu);
+        return { success: true, model: modelId, localPath, cpuMode: result.cpuMode };
     } catch (error) {
         return { success: false, error: error.message };
     }
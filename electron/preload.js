@@ -57,6 +57,8 @@ contextBridge.exposeInMainWorld('electronAPI', {
     generateImage: (params) => ipcRenderer.invoke('generate-image', params),
     loadImageModel: (modelId) => ipcRenderer.invoke('load-image-model', modelId),
     unloadImageModel: () => ipcRenderer.invoke('unload-image-model'),
+    cancelImageGeneration: (jobId) => ipcRenderer.invoke('cancel-image-generation', jobId),
+    listImageJobs: () => ipcRenderer.invoke('list-image-jobs'),
     checkImageGenStatus: () => ipcRenderer.invoke('check-image-gen-status'),
     checkPythonSetup: () => ipcRenderer.invoke('check-python-setup'),
     onImageGenProgress: (callback) => ipcRenderer.on('image-gen-progress', (event, data) => callback(data)),
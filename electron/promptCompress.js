@@ -5,11 +5,20 @@
 
 const { spawn } = require('child_process');
 const path = require('path');
+const readline = require('readline');
 const fs = require('fs');
 
 let pythonCmd = null;
 let isAvailable = null;
 
+// Persistent `--mode serve` process (keeps the LLMLingua model warm)
+let serverProcess = null;
+let serverReady = null;
+let nextRequestId = 1;
+const pendingRequests = new Map();
+// How long to wait for the server to load (or download) the model
+const STARTUP_TIMEOUT_MS = 120000;
+
 /**
  * Find Python command (python or python3)
  */
@@ -86,113 +95,172 @@ async function checkAvailable() {
 }
 
 /**
- * Compress a single text prompt
- * @param {string} text - Text to compress
- * @param {number} ratio - Target compression ratio (0.5 = 50%)
- * @returns {Promise<string>} Compressed text
+ * Start the long-lived compression server if it isn't running yet
+ * @returns {Promise<boolean>} Whether the server is ready and LLMLingua loaded
  */
-async function compressText(text, ratio = 0.5) {
+function startServer() {
+    if (serverReady) return serverReady;
+    
     const python = findPython();
     const script = getScriptPath();
     
     if (!python || !script) {
-        console.log('LLMLingua not available, returning original text');
-        return text;
+        return Promise.resolve(false);
     }
     
-    return new Promise((resolve) => {
-        const proc = spawn(python, [
-            script,
-            '--mode', 'text',
-            '--ratio', ratio.toString(),
-            '--input', text
-        ], {
-            timeout: 60000
+    serverReady = new Promise((resolve) => {
+        const proc = spawn(python, [script, '--mode', 'serve', '--cache-disk'], {
+            stdio: ['pipe', 'pipe', 'pipe']
         });
+        serverProcess = proc;
         
-        let output = '';
-        let error = '';
+        const reset = () => {
+            clearTimeout(startupTimeout);
+            // A later startServer() may already have replaced this process
+            if (serverProcess !== proc) return;
+            serverProcess = null;
+            serverReady = null;
+            for (const pending of pendingRequests.values()) {
+                clearTimeout(pending.timeout);
+                pending.resolve(null);
+            }
+            pendingRequests.clear();
+            resolve(false);
+        };
         
-        proc.stdout.on('data', (data) => {
-            output += data.toString();
-        });
+        // Give up on a server that never gets ready (or can't compress), so
+        // the next call starts a fresh one instead of waiting forever
+        const abandon = (reason) => {
+            console.error(`LLMLingua server ${reason}`);
+            reset();
+            proc.kill();
+        };
         
-        proc.stderr.on('data', (data) => {
-            error += data.toString();
+        const startupTimeout = setTimeout(() => abandon('startup timeout'), STARTUP_TIMEOUT_MS);
+        
+        const rl = readline.createInterface({
+            input: proc.stdout,
+            crlfDelay: Infinity
         });
         
-        proc.on('close', (code) => {
-            if (code === 0 && output) {
-                try {
-                    const result = JSON.parse(output);
-                    resolve(result.result || text);
-                } catch {
-                    resolve(text);
+        rl.on('line', (line) => {
+            let data;
+            try {
+                data = JSON.parse(line);
+            } catch {
+                console.error('Failed to parse compression output:', line);
+                return;
+            }
+            
+            if (data.type === 'ready') {
+                clearTimeout(startupTimeout);
+                if (data.available !== true) {
+                    abandon('started without LLMLingua');
+                    return;
                 }
-            } else {
-                console.error('Compression error:', error);
-                resolve(text);
+                console.log(`LLMLingua server ready (model load: ${data.load_ms}ms)`);
+                resolve(true);
+                return;
+            }
+            
+            const pending = pendingRequests.get(data.id);
+            if (pending) {
+                pendingRequests.delete(data.id);
+                clearTimeout(pending.timeout);
+                pending.resolve(data);
+            }
+        });
+        
+        proc.stderr.on('data', (data) => {
+            const msg = data.toString();
+            if (msg.includes('"error"')) {
+                console.error('Compression stderr:', msg);
             }
         });
         
         proc.on('error', (err) => {
-            console.error('Failed to run compression:', err);
-            resolve(text);
+            console.error('Failed to start compression server:', err);
+            reset();
         });
+        
+        proc.on('close', reset);
+    });
+    
+    return serverReady;
+}
+
+/**
+ * Send a request to the compression server
+ * @param {Object} request - Request payload ({action, ...})
+ * @param {number} timeoutMs - Time to wait for the response
+ * @returns {Promise<Object|null>} Response, or null on failure
+ */
+async function sendRequest(request, timeoutMs = 60000) {
+    const ready = await startServer();
+    if (!ready || !serverProcess) return null;
+    
+    const id = nextRequestId++;
+    return new Promise((resolve) => {
+        const timeout = setTimeout(() => {
+            pendingRequests.delete(id);
+            resolve(null);
+        }, timeoutMs);
+        
+        pendingRequests.set(id, { resolve, timeout });
+        serverProcess.stdin.write(JSON.stringify({ id, ...request }) + '\n');
     });
 }
 
+/**
+ * Compress a single text prompt
+ * @param {string} text - Text to compress
+ * @param {number} ratio - Target compression ratio (0.5 = 50%)
+ * @returns {Promise<string>} Compressed text
+ */
+async function compressText(text, ratio = 0.5) {
+    const response = await sendRequest({ action: 'text', text, ratio });
+    
+    if (!response || response.type !== 'result') {
+        if (response?.error) console.error('Compression error:', response.error);
+        return text;
+    }
+    return response.result || text;
+}
+
 /**
  * Compress chat messages
  * @param {Array} messages - Array of {role, content} messages
  * @param {number} ratio - Target compression ratio
+ * @param {number|null} budget - Optional token budget (e.g. the model's context size);
+ *   when set, messages are only compressed as far as needed to fit it
  * @returns {Promise<Array>} Compressed messages
  */
-async function compressMessages(messages, ratio = 0.6) {
-    const python = findPython();
-    const script = getScriptPath();
+async function compressMessages(messages, ratio = 0.6, budget = null) {
+    const request = { action: 'messages', messages, ratio };
+    if (budget) request.budget = budget;
     
-    if (!python || !script) {
-        console.log('LLMLingua not available, returning original messages');
+    const response = await sendRequest(request, 120000);
+    
+    if (!response || response.type !== 'result') {
         return messages;
     }
-    
-    return new Promise((resolve) => {
-        const proc = spawn(python, [
-            script,
-            '--mode', 'messages',
-            '--ratio', ratio.toString()
-        ], {
-            timeout: 120000
-        });
-        
-        let output = '';
-        
-        // Send messages as JSON to stdin
-        proc.stdin.write(JSON.stringify(messages));
-        proc.stdin.end();
-        
-        proc.stdout.on('data', (data) => {
-            output += data.toString();
-        });
-        
-        proc.on('close', (code) => {
-            if (code === 0 && output) {
-                try {
-                    const result = JSON.parse(output);
-                    resolve(result.result || messages);
-                } catch {
-                    resolve(messages);
-                }
-            } else {
-                resolve(messages);
-            }
-        });
-        
-        proc.on('error', () => {
-            resolve(messages);
-        });
-    });
+    return response.result || messages;
+}
+
+/**
+ * Stop the compression server
+ */
+function stopServer() {
+    if (serverProcess) {
+        try {
+            serverProcess.stdin.write(JSON.stringify({ action: 'quit' }) + '\n');
+        } catch {
+            // Ignore
+        }
+        serverProcess.kill();
+        serverProcess = null;
+        serverReady = null;
+    }
 }
 
 /**
@@ -227,5 +295,6 @@ module.exports = {
     compressText,
     compressMessages,
     simpleCompress,
+    stopServer,
     findPython
 };
@@ -9,14 +9,30 @@ import sys
 import json
 import os
 import base64
+import hashlib
+import itertools
+import struct
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import nullcontext
 from io import BytesIO
 
 # Disable progress bars for cleaner output
 os.environ["HF_HUB_DISABLE_PROGRESS_BARS"] = "1"
 
+# Job the current thread is running (set on the worker thread)
+job_context = threading.local()
+output_lock = threading.Lock()
+
 def send_response(data):
-    """Send JSON response to stdout"""
-    print(json.dumps(data), flush=True)
+    """Send JSON response to stdout, tagged with the current job's id"""
+    job = getattr(job_context, 'job', None)
+    if job is not None and "job_id" not in data:
+        data = {**data, "job_id": job.id}
+    with output_lock:
+        print(json.dumps(data), flush=True)
 
 def send_progress(message, progress=None):
     """Send progress update"""
@@ -25,11 +41,250 @@ def send_progress(message, progress=None):
         data["progress"] = progress
     send_response(data)
 
-# Global model cache
+# Active model (the one generate uses); all loaded models live in `models`
 pipeline = None
 sd_cpp_model = None  # For GGUF models
 current_model = None
 model_type = None  # 'diffusers' or 'gguf'
+cpu_mode = None  # CPU settings and optimizations of the active diffusers model
+
+# Resident model limits. Budgets are in MB; unset means a share of the
+# device's memory. With offload on, idle diffusers models are moved from
+# the GPU to RAM instead of being unloaded.
+MAX_MODELS = int(os.environ.get("OPENMIND_IMAGE_MAX_MODELS", "3"))
+GPU_BUDGET_MB = os.environ.get("OPENMIND_IMAGE_GPU_BUDGET_MB")
+RAM_BUDGET_MB = os.environ.get("OPENMIND_IMAGE_RAM_BUDGET_MB")
+OFFLOAD_IDLE = os.environ.get("OPENMIND_IMAGE_OFFLOAD", "1") != "0"
+
+class ResidentModel:
+    """A loaded pipeline or stable-diffusion-cpp model"""
+    
+    def __init__(self, key, kind, model, device, size, cpu_mode=None):
+        self.key = key
+        self.kind = kind  # 'diffusers' or 'gguf'
+        self.model = model
+        self.device = device  # Device it runs on when active
+        self.size = size  # Bytes of weights
+        self.cpu_mode = cpu_mode  # See load_model(), None off the CPU
+        self.offloaded = False  # Diffusers model parked in RAM
+        self.last_used = time.time()
+        self.seconds_per_step = None  # Measured by the last generate
+    
+    def pool(self):
+        """Which memory the model occupies right now: 'gpu' or 'cpu'"""
+        return "cpu" if self.offloaded or self.device == "cpu" else "gpu"
+    
+    def info(self):
+        return {
+            "model": self.key,
+            "type": self.kind,
+            "device": "cpu" if self.offloaded else self.device,
+            "offloaded": self.offloaded,
+            "memory_mb": round(self.size / (1024 * 1024), 1),
+            "active": self.key == current_model,
+            "idle_seconds": round(time.time() - self.last_used, 1),
+            "cpu_mode": self.cpu_mode,
+            "seconds_per_step": self.seconds_per_step
+        }
+
+def model_size(kind, model, path=None):
+    """Approximate bytes of weights of a loaded model"""
+    if kind == "gguf":
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+    total = 0
+    for component in getattr(model, "components", {}).values():
+        for tensors in (getattr(component, "parameters", None), getattr(component, "buffers", None)):
+            if callable(tensors):
+                total += sum(t.numel() * t.element_size() for t in tensors())
+    return total
+
+def free_memory():
+    """Give freed model memory back after unloading or offloading"""
+    import gc
+    gc.collect()
+    try:
+        import torch
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    except Exception:
+        pass
+
+class ModelRegistry:
+    """
+    Loaded models by key, least recently used first. Keeps at most
+    max_models resident and within per-pool (GPU, RAM) memory budgets,
+    offloading or unloading the least recently used idle models.
+    """
+    
+    def __init__(self, max_models=MAX_MODELS, offload=OFFLOAD_IDLE):
+        self.models = OrderedDict()
+        self.max_models = max(1, max_models)
+        self.offload = offload
+        self.budgets = None  # {"gpu": bytes, "cpu": bytes}, resolved on first use
+        self.lock = threading.Lock()
+    
+    def _budgets(self):
+        if self.budgets is None:
+            gpu = float(GPU_BUDGET_MB) * 1024 * 1024 if GPU_BUDGET_MB else None
+            cpu = float(RAM_BUDGET_MB) * 1024 * 1024 if RAM_BUDGET_MB else None
+            if gpu is None:
+                try:
+                    import torch
+                    if torch.cuda.is_available():
+                        gpu = torch.cuda.get_device_properties(0).total_memory * 0.8
+                except Exception:
+                    pass
+            if cpu is None:
+                try:
+                    import psutil
+                    cpu = psutil.virtual_memory().total * 0.5
+                except ImportError:
+                    pass
+            # None = no limit beyond max_models
+            self.budgets = {"gpu": gpu, "cpu": cpu}
+        return self.budgets
+    
+    def _set_active(self, entry):
+        global pipeline, sd_cpp_model, current_model, model_type, cpu_mode
+        pipeline = entry.model if entry and entry.kind == "diffusers" else None
+        sd_cpp_model = entry.model if entry and entry.kind == "gguf" else None
+        current_model = entry.key if entry else None
+        model_type = entry.kind if entry else None
+        cpu_mode = entry.cpu_mode if entry else None
+    
+    def add(self, key, kind, model, device, size, cpu_mode=None):
+        """Register a freshly loaded model and make it the active one"""
+        with self.lock:
+            self.models.pop(key, None)
+            entry = ResidentModel(key, kind, model, device, size, cpu_mode)
+            self.models[key] = entry
+            self._set_active(entry)
+        self._enforce()
+    
+    def activate(self, key):
+        """Make a resident model active (moving it back from RAM if offloaded); False if not resident"""
+        with self.lock:
+            entry = self.models.get(key)
+            if entry is None:
+                return False
+            self.models.move_to_end(key)
+            entry.last_used = time.time()
+        if entry.offloaded:
+            # Make room first, or the move runs out of GPU memory
+            self.reserve(key, entry.size, "gpu")
+            send_progress(f"Moving {os.path.basename(key)} back to {entry.device}...")
+            entry.model = entry.model.to(entry.device)
+            entry.offloaded = False
+        with self.lock:
+            self._set_active(entry)
+        self._enforce()
+        return True
+    
+    def touch(self):
+        """Mark the active model as just used"""
+        with self.lock:
+            entry = self.models.get(current_model)
+            if entry is not None:
+                entry.last_used = time.time()
+    
+    def record_speed(self, seconds_per_step):
+        """Remember the active model's measured seconds per denoising step"""
+        with self.lock:
+            entry = self.models.get(current_model)
+            if entry is not None and seconds_per_step is not None:
+                entry.seconds_per_step = seconds_per_step
+    
+    def remove(self, key=None):
+        """Unload one model, or every model when key is None"""
+        with self.lock:
+            keys = list(self.models) if key is None else [key]
+            for k in keys:
+                self.models.pop(k, None)
+                prompt_cache.forget(k)
+            if current_model in keys:
+                self._set_active(None)
+        free_memory()
+    
+    def _usage(self, pool):
+        return sum(e.size for e in self.models.values() if e.pool() == pool)
+    
+    def reserve(self, key, size, pool):
+        """
+        Offload or unload other models (the active one included) until a
+        model of `size` bytes fits in `pool`; call before moving it there
+        """
+        with self.lock:
+            entry = self.models.get(key)
+        incoming = {pool: size}
+        if entry is not None and entry.pool() != pool:
+            # A resident model moving pools frees what it uses in the other
+            incoming[entry.pool()] = -entry.size
+        self._enforce(keep=key, incoming=incoming, new=entry is None)
+    
+    def _enforce(self, keep=None, incoming=None, new=False):
+        """
+        Offload or unload idle models until the limits hold, counting
+        `incoming` bytes per pool (and one more model when `new`) for a
+        model that isn't there yet. Models other than `keep` (default: the
+        active one) are idle.
+        """
+        budgets = self._budgets()
+        incoming = incoming or {}
+        changed = False
+        while True:
+            with self.lock:
+                keep_key = current_model if keep is None else keep
+                idle = [e for e in self.models.values() if e.key != keep_key]
+                victim = None
+                action = None
+                if len(self.models) + (1 if new else 0) > self.max_models and idle:
+                    victim, action = idle[0], "unload"
+                else:
+                    for pool in ("gpu", "cpu"):
+                        budget = budgets[pool]
+                        candidates = [e for e in idle if e.pool() == pool]
+                        if budget is not None and self._usage(pool) + incoming.get(pool, 0) > budget and candidates:
+                            victim = candidates[0]
+                            can_offload = pool == "gpu" and self.offload and victim.kind == "diffusers"
+                            action = "offload" if can_offload else "unload"
+                            break
+                if victim is None:
+                    break
+                if action == "unload":
+                    self.models.pop(victim.key)
+                    if victim.key == current_model:
+                        # Drop the global reference too, or the memory isn't freed
+                        self._set_active(None)
+            
+            if action == "offload":
+                send_progress(f"Offloading {os.path.basename(victim.key)} to RAM")
+                victim.model = victim.model.to("cpu")
+                victim.offloaded = True
+            else:
+                send_progress(f"Unloaded {os.path.basename(victim.key)}")
+            # Its embeddings would otherwise stay behind on the GPU
+            prompt_cache.forget(victim.key)
+            changed = True
+        if changed:
+            free_memory()
+    
+    def status(self):
+        budgets = self._budgets()
+        with self.lock:
+            return {
+                "resident_models": [e.info() for e in reversed(self.models.values())],
+                "max_models": self.max_models,
+                "offload_idle": self.offload,
+                "gpu_budget_mb": round(budgets["gpu"] / (1024 * 1024)) if budgets["gpu"] else None,
+                "ram_budget_mb": round(budgets["cpu"] / (1024 * 1024)) if budgets["cpu"] else None,
+                "gpu_used_mb": round(self._usage("gpu") / (1024 * 1024), 1),
+                "ram_used_mb": round(self._usage("cpu") / (1024 * 1024), 1)
+            }
+
+models = ModelRegistry()
 
 def is_gguf_model(path):
     """Check if path points to a GGUF model"""
@@ -114,8 +369,6 @@ def check_sd_cpp_cuda():
 
 def load_gguf_model(model_path):
     """Load a GGUF model using stable-diffusion-cpp-python"""
-    global sd_cpp_model, current_model, model_type, pipeline
-    
     try:
         from stable_diffusion_cpp import StableDiffusion
         
@@ -132,9 +385,8 @@ def load_gguf_model(model_path):
         else:
             send_progress(f"GGUF backend: CPU only (CUDA not compiled)")
         
-        # Unload any existing model
-        pipeline = None
-        sd_cpp_model = None
+        size = model_size('gguf', None, gguf_file)
+        models.reserve(model_path, size, "gpu" if sd_cpp_cuda else "cpu")
         
         # Get number of CPU threads
         import multiprocessing
@@ -149,8 +401,7 @@ def load_gguf_model(model_path):
             verbose=False  # Reduce console spam
         )
         
-        current_model = model_path
-        model_type = 'gguf'
+        models.add(model_path, 'gguf', sd_cpp_model, "cuda" if sd_cpp_cuda else "cpu", size)
         
         if sd_cpp_cuda:
             send_progress(f"GGUF model loaded (GPU accelerated)")
@@ -168,32 +419,326 @@ def load_gguf_model(model_path):
         send_response({"type": "error", "error": f"Failed to load GGUF model: {str(e)}"})
         return False
 
-def load_model(model_id, local_path=None):
-    """Load a diffusion model from HuggingFace or local path"""
-    global pipeline, sd_cpp_model, current_model, model_type
+# Probe index, compiled UNets and exported models live here
+IMAGE_GEN_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models", "image_gen")
+
+# Persistent record of each model's architecture and the loader that works
+PROBE_INDEX_PATH = os.environ.get(
+    "OPENMIND_IMAGE_PROBE_INDEX",
+    os.path.join(IMAGE_GEN_CACHE, "probe_index.json")
+)
+
+# Pipeline class for each single-file architecture
+SINGLE_FILE_LOADERS = {
+    "sdxl": "StableDiffusionXLPipeline",
+    "sd2": "StableDiffusionPipeline",
+    "sd1": "StableDiffusionPipeline",
+    "sd3": "StableDiffusion3Pipeline",
+    "flux": "FluxPipeline"
+}
+
+# Text-to-image pipeline classes (model_index.json _class_name) by architecture label
+TEXT2IMAGE_ARCHS = {
+    "StableDiffusionXLPipeline": "sdxl",
+    "StableDiffusionPipeline": "sd",
+    "FluxPipeline": "flux",
+    "StableDiffusion3Pipeline": "sd3"
+}
+
+class ProbeIndex:
+    """
+    JSON file mapping a model fingerprint (path + size + mtime, or the hub
+    id) to its detected architecture and the loader that worked, so repeat
+    loads skip detection and failed attempts
+    """
+    
+    def __init__(self, path=PROBE_INDEX_PATH):
+        self.path = path
+        self.entries = None
+        self.lock = threading.Lock()
+    
+    @staticmethod
+    def fingerprint(source):
+        if not os.path.exists(source):
+            return f"hub:{source}"
+        path = os.path.abspath(source)
+        # For directories, model_index.json changes whenever the model does
+        marker = os.path.join(path, "model_index.json") if os.path.isdir(path) else path
+        if not os.path.exists(marker):
+            marker = path
+        stat = os.stat(marker)
+        return f"{path}|{stat.st_size}|{int(stat.st_mtime)}"
+    
+    def _entries(self):
+        if self.entries is None:
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError):
+                self.entries = {}
+        return self.entries
+    
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.entries, f, indent=2)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Could not save probe index: {e}", file=sys.stderr)
+    
+    def lookup(self, source):
+        with self.lock:
+            entry = self._entries().get(self.fingerprint(source))
+        # Older probes could record an inpaint/img2img class as the loader
+        loaders = set(TEXT2IMAGE_ARCHS) | set(SINGLE_FILE_LOADERS.values()) | {"AutoPipelineForText2Image", "DiffusionPipeline"}
+        if entry and entry.get("loader") not in loaders:
+            return None
+        return entry
+    
+    def record(self, source, arch, loader, method):
+        key = self.fingerprint(source)
+        with self.lock:
+            entries = self._entries()
+            # Drop entries for older versions of the same file
+            prefix = key.split("|")[0] + "|"
+            for old in [k for k in entries if k.startswith(prefix) and k != key]:
+                del entries[old]
+            entries[key] = {"arch": arch, "loader": loader, "method": method, "updated": int(time.time())}
+            self._save()
+    
+    def forget(self, source):
+        with self.lock:
+            if self._entries().pop(self.fingerprint(source), None) is not None:
+                self._save()
+
+probe_index = ProbeIndex()
+
+def read_safetensors_keys(path):
+    """Tensor names from a safetensors header (reads only the header)"""
+    with open(path, "rb") as f:
+        length = struct.unpack("<Q", f.read(8))[0]
+        if length > 100 * 1024 * 1024:
+            raise ValueError("Implausible safetensors header")
+        header = json.loads(f.read(length))
+    return [k for k in header if k != "__metadata__"]
+
+def detect_single_file_arch(keys):
+    """Architecture of an original-format checkpoint from its tensor names"""
+    if any(".double_blocks." in k or k.startswith("double_blocks.") for k in keys):
+        return "flux"
+    if any(".joint_blocks." in k for k in keys):
+        return "sd3"
+    if any(k.startswith("conditioner.embedders.1.") for k in keys):
+        return "sdxl"
+    if any(k.startswith("cond_stage_model.model.") for k in keys):
+        return "sd2"  # OpenCLIP text encoder
+    if any(k.startswith("cond_stage_model.transformer.") for k in keys):
+        return "sd1"
+    return None
+
+def probe_model(path):
+    """
+    Detect a local model's architecture and pipeline class without loading
+    weights: from model_index.json for directories, from the safetensors
+    header for single files
+    
+    Returns:
+        {"arch", "loader", "method"} or None if it can't be told cheaply
+    """
+    try:
+        if os.path.isdir(path):
+            with open(os.path.join(path, "model_index.json"), "r", encoding="utf-8") as f:
+                class_name = json.load(f).get("_class_name")
+            if class_name:
+                if class_name in TEXT2IMAGE_ARCHS:
+                    return {"arch": TEXT2IMAGE_ARCHS[class_name], "loader": class_name, "method": "from_pretrained"}
+                # Inpaint, img2img, upscaler and other pipelines need an input
+                # image; AutoPipeline maps them to their text-to-image class
+                return {"arch": class_name, "loader": "AutoPipelineForText2Image", "method": "from_pretrained"}
+        elif path.lower().endswith(".safetensors"):
+            arch = detect_single_file_arch(read_safetensors_keys(path))
+            if arch:
+                return {"arch": arch, "loader": SINGLE_FILE_LOADERS[arch], "method": "from_single_file"}
+    except (OSError, ValueError, struct.error):
+        pass
+    return None
+
+def load_with(loader, method, source, dtype, local_files_only=False):
+    """Load a pipeline with a known diffusers class and method"""
+    import diffusers
+    cls = getattr(diffusers, loader)
+    kwargs = {"torch_dtype": dtype}
+    if loader in ("AutoPipelineForText2Image", "StableDiffusionPipeline"):
+        kwargs["safety_checker"] = None
+    if loader == "AutoPipelineForText2Image":
+        kwargs["requires_safety_checker"] = False
+    if method == "from_single_file":
+        kwargs["use_safetensors"] = source.lower().endswith(".safetensors")
+        return cls.from_single_file(source, **kwargs)
+    return cls.from_pretrained(source, local_files_only=local_files_only, **kwargs)
+
+# CPU inference defaults, overridable per load with the command's "cpu"
+# field. threads: intra-op threads (default: physical cores); bf16: "auto"
+# uses bfloat16 autocast when the CPU supports it; compile: torch.compile
+# the UNet; backend: "torch", or "openvino"/"onnx" to run an exported copy.
+CPU_DEFAULTS = {
+    "threads": os.environ.get("OPENMIND_IMAGE_CPU_THREADS"),
+    "interop_threads": os.environ.get("OPENMIND_IMAGE_CPU_INTEROP_THREADS"),
+    "bf16": os.environ.get("OPENMIND_IMAGE_BF16", "auto"),
+    "compile": os.environ.get("OPENMIND_IMAGE_COMPILE", "0"),
+    "backend": os.environ.get("OPENMIND_IMAGE_CPU_BACKEND", "torch")
+}
+CPU_BACKENDS = ("torch", "openvino", "onnx")
+
+# Inductor's cache, so a compiled UNet is reused by later runs
+COMPILE_CACHE_DIR = os.path.join(IMAGE_GEN_CACHE, "compile")
+# OpenVINO / ONNX Runtime exports, one directory per model fingerprint
+EXPORT_DIR = os.path.join(IMAGE_GEN_CACHE, "export")
+
+def get_cpu_options(overrides=None):
+    """CPU_DEFAULTS merged with a load command's "cpu" settings"""
+    options = {**CPU_DEFAULTS, **{k: v for k, v in (overrides or {}).items() if v is not None}}
+    
+    def flag(value):
+        return str(value).lower() in ("1", "true", "yes", "on")
+    
+    backend = str(options["backend"]).lower()
+    if backend not in CPU_BACKENDS:
+        raise ValueError(f"Unknown CPU backend: {backend}")
+    bf16 = options["bf16"]
+    return {
+        "threads": int(options["threads"]) if options["threads"] else None,
+        "interop_threads": int(options["interop_threads"]) if options["interop_threads"] else None,
+        "bf16": "auto" if str(bf16).lower() == "auto" else flag(bf16),
+        "compile": flag(options["compile"]),
+        "backend": backend
+    }
+
+def configure_cpu_threads(options):
+    """Apply the thread settings; returns the (intra-op, inter-op) counts in effect"""
+    import torch
+    threads = options["threads"]
+    if threads is None:
+        try:
+            import psutil
+            # Hyperthreads slow the UNet's matmuls down rather than up
+            threads = psutil.cpu_count(logical=False)
+        except ImportError:
+            pass
+    if threads:
+        torch.set_num_threads(threads)
+    if options["interop_threads"]:
+        try:
+            torch.set_num_interop_threads(options["interop_threads"])
+        except RuntimeError:
+            # Can only be set before the first inter-op parallel work
+            send_progress("Inter-op threads are already fixed for this process")
+    return torch.get_num_threads(), torch.get_num_interop_threads()
+
+def cpu_supports_bf16():
+    import torch
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except Exception:
+        return False
+
+def apply_cpu_optimizations(pipe, options):
+    """
+    channels_last, bf16 autocast and torch.compile for a PyTorch pipeline
+    on the CPU
+    
+    Returns:
+        (names of the optimizations applied, whether to run under bf16 autocast)
+    """
+    import torch
+    applied = []
+    
+    try:
+        for name in ("unet", "vae"):
+            component = getattr(pipe, name, None)
+            if component is not None:
+                component.to(memory_format=torch.channels_last)
+        applied.append("channels_last")
+    except Exception as e:
+        send_progress(f"channels_last not applied: {str(e)[:80]}")
+    
+    autocast = False
+    if options["bf16"]:
+        if cpu_supports_bf16():
+            autocast = True
+            applied.append("bf16_autocast")
+        elif options["bf16"] is True:
+            send_progress("This CPU has no bfloat16 support, staying in float32")
+    
+    unet = getattr(pipe, "unet", None)
+    if options["compile"] and unet is not None and hasattr(torch, "compile"):
+        try:
+            os.makedirs(COMPILE_CACHE_DIR, exist_ok=True)
+            os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", COMPILE_CACHE_DIR)
+            try:
+                import torch._inductor.config as inductor_config
+                inductor_config.fx_graph_cache = True
+            except (ImportError, AttributeError):
+                pass
+            # Compiles lazily, on the first generate
+            pipe.unet = torch.compile(unet)
+            applied.append("torch_compile")
+        except Exception as e:
+            send_progress(f"torch.compile not applied: {str(e)[:80]}")
+    
+    return applied, autocast
+
+def load_exported_pipeline(source, backend, local_files_only=False, threads=None):
+    """
+    Load an OpenVINO or ONNX Runtime copy of a diffusers model, exporting
+    it under EXPORT_DIR on the first load
+    """
+    kwargs = {}
+    if backend == "openvino":
+        from optimum.intel import OVPipelineForText2Image as cls
+        if threads:
+            kwargs["ov_config"] = {"INFERENCE_NUM_THREADS": threads}
+    else:
+        from optimum.onnxruntime import ORTPipelineForText2Image as cls
+    
+    key = hashlib.sha1(ProbeIndex.fingerprint(source).encode("utf-8")).hexdigest()[:16]
+    export_path = os.path.join(EXPORT_DIR, backend, key)
+    if os.path.exists(os.path.join(export_path, "model_index.json")):
+        send_progress(f"Loading {backend} export...")
+        return cls.from_pretrained(export_path, **kwargs)
+    
+    send_progress(f"Exporting to {backend} (first load only, this takes a while)...")
+    pipe = cls.from_pretrained(source, export=True, local_files_only=local_files_only, **kwargs)
+    pipe.save_pretrained(export_path)
+    return pipe
+
+def load_model(model_id, local_path=None, cpu_options=None):
+    """
+    Load a diffusion model from HuggingFace or local path
     
+    cpu_options override CPU_DEFAULTS when the model runs on the CPU.
+    """
     # Use local path if provided, otherwise use model_id
     model_source = local_path if local_path else model_id
     cache_key = local_path if local_path else model_id
     
-    if current_model == cache_key and (pipeline is not None or sd_cpp_model is not None):
-        send_progress("Model already loaded")
-        return True
-    
-    # Check if this is a GGUF model
-    if local_path and is_gguf_model(local_path):
-        return load_gguf_model(local_path)
-    
     try:
+        # Moving an offloaded model back can run out of GPU memory too
+        if models.activate(cache_key):
+            send_progress("Model already loaded")
+            return True
+        
+        # Check if this is a GGUF model
+        if local_path and is_gguf_model(local_path):
+            return load_gguf_model(local_path)
+        
         send_progress(f"Loading model: {model_id}...")
         
         import torch
         from diffusers import AutoPipelineForText2Image, DiffusionPipeline, StableDiffusionPipeline, StableDiffusionXLPipeline
         
-        # Clear any GGUF model
-        sd_cpp_model = None
-        model_type = 'diffusers'
-        
         # Determine device
         if torch.cuda.is_available():
             device = "cuda"
@@ -210,9 +755,45 @@ def load_model(model_id, local_path=None):
         
         loaded = False
         is_single_file = local_path and is_single_file_model(local_path)
+        arch = None
+        loader = None
+        method = "from_single_file" if is_single_file else "from_pretrained"
+        
+        backend = "torch"
+        options = None
+        if device == "cpu":
+            options = get_cpu_options(cpu_options)
+            threads, interop_threads = configure_cpu_threads(options)
+            if options["backend"] != "torch":
+                if is_single_file:
+                    send_progress(f"{options['backend']} needs a diffusers directory or hub model, using PyTorch")
+                else:
+                    try:
+                        pipeline = load_exported_pipeline(model_source, options["backend"], bool(local_path), threads)
+                        backend = options["backend"]
+                        loaded = True
+                    except Exception as e:
+                        send_progress(f"{options['backend']} unavailable ({str(e)[:80]}), using PyTorch")
+        
+        # Go straight to the right pipeline class when it is known from an
+        # earlier load or can be read from model_index.json / the header
+        known = probe_index.lookup(model_source) if not loaded else None
+        recorded = known is not None
+        if known is None and local_path and not loaded:
+            known = probe_model(local_path)
+        if known:
+            try:
+                send_progress(f"Loading as {known['loader']}...")
+                pipeline = load_with(known["loader"], known["method"], model_source, dtype, bool(local_path))
+                arch, loader, method = known["arch"], known["loader"], known["method"]
+                loaded = True
+            except Exception as e:
+                send_progress(f"{known['loader']} failed ({str(e)[:80]}), trying alternatives...")
+                if recorded:
+                    probe_index.forget(model_source)
         
         # Check if this is a single file model (.safetensors, .ckpt)
-        if is_single_file:
+        if is_single_file and not loaded:
             file_ext = os.path.splitext(local_path)[1].lower()
             send_progress(f"Loading single file model: {os.path.basename(local_path)}...")
             
@@ -236,21 +817,19 @@ def load_model(model_id, local_path=None):
                         use_safetensors=file_ext == '.safetensors'
                     )
                     loaded = True
+                    arch, loader = "sdxl", "StableDiffusionXLPipeline"
                     send_progress("Loaded as SDXL model")
                 elif is_sd2:
                     # SD 2.x models need special handling
                     send_progress("Detected SD 2.x model (768px)...")
-                    from diffusers import EulerDiscreteScheduler
-                    
                     pipeline = StableDiffusionPipeline.from_single_file(
                         local_path,
                         torch_dtype=dtype,
                         safety_checker=None,
                         use_safetensors=file_ext == '.safetensors'
                     )
-                    # SD 2.x works better with Euler scheduler
-                    pipeline.scheduler = EulerDiscreteScheduler.from_config(pipeline.scheduler.config)
                     loaded = True
+                    arch, loader = "sd2", "StableDiffusionPipeline"
                     send_progress("Loaded as SD 2.x model (768px)")
                 else:
                     # Try SD 1.5 single file
@@ -262,6 +841,7 @@ def load_model(model_id, local_path=None):
                         use_safetensors=file_ext == '.safetensors'
                     )
                     loaded = True
+                    arch, loader = "sd1", "StableDiffusionPipeline"
                     send_progress("Loaded as SD 1.5 model")
             except Exception as e:
                 error_msg = str(e)
@@ -274,6 +854,7 @@ def load_model(model_id, local_path=None):
                         use_safetensors=file_ext == '.safetensors'
                     )
                     loaded = True
+                    arch, loader = "sdxl", "StableDiffusionXLPipeline"
                     send_progress("Loaded as SDXL model (fallback)")
                 except Exception as e2:
                     # Provide helpful error message for .ckpt files
@@ -303,6 +884,7 @@ def load_model(model_id, local_path=None):
                     local_files_only=bool(local_path)
                 )
                 loaded = True
+                loader = "AutoPipelineForText2Image"
             except Exception as e:
                 send_progress(f"AutoPipeline failed, trying alternatives...")
         
@@ -315,6 +897,7 @@ def load_model(model_id, local_path=None):
                     local_files_only=bool(local_path)
                 )
                 loaded = True
+                arch, loader = "sdxl", "StableDiffusionXLPipeline"
             except:
                 pass
         
@@ -328,6 +911,7 @@ def load_model(model_id, local_path=None):
                     local_files_only=bool(local_path)
                 )
                 loaded = True
+                arch, loader = "sd", "StableDiffusionPipeline"
             except:
                 pass
         
@@ -340,6 +924,7 @@ def load_model(model_id, local_path=None):
                     local_files_only=bool(local_path)
                 )
                 loaded = True
+                loader = "DiffusionPipeline"
             except Exception as e:
                 raise Exception(f"Could not load model with any pipeline: {str(e)}")
         
@@ -347,7 +932,16 @@ def load_model(model_id, local_path=None):
         if not loaded:
             raise Exception(f"Could not load model. Single file: {is_single_file}, Path: {local_path or model_id}")
         
-        pipeline = pipeline.to(device)
+        if arch == "sd2":
+            # SD 2.x works better with Euler scheduler
+            from diffusers import EulerDiscreteScheduler
+            pipeline.scheduler = EulerDiscreteScheduler.from_config(pipeline.scheduler.config)
+        
+        size = model_size('diffusers', pipeline)
+        models.reserve(cache_key, size, "cpu" if device == "cpu" else "gpu")
+        if backend == "torch":
+            probe_index.record(model_source, arch or type(pipeline).__name__, loader, method)
+            pipeline = pipeline.to(device)
         
         # Enable memory optimizations
         if device == "cuda":
@@ -360,7 +954,21 @@ def load_model(model_id, local_path=None):
             except:
                 pass
         
-        current_model = cache_key
+        mode = None
+        if options is not None:
+            applied, autocast = [backend], False
+            if backend == "torch":
+                applied, autocast = apply_cpu_optimizations(pipeline, options)
+            mode = {
+                "backend": backend,
+                "threads": threads,
+                "interop_threads": interop_threads,
+                "optimizations": applied,
+                "autocast": autocast
+            }
+            send_progress(f"CPU mode: {', '.join(applied) or 'no optimizations'}, {threads} threads")
+        
+        models.add(cache_key, 'diffusers', pipeline, device, size, mode)
         send_progress("Model loaded successfully!")
         return True
         
@@ -368,8 +976,452 @@ def load_model(model_id, local_path=None):
         send_response({"type": "error", "error": f"Failed to load model: {str(e)}"})
         return False
 
-def generate_image(prompt, negative_prompt="", width=512, height=512, steps=20, guidance=7.5, seed=None):
-    """Generate an image from prompt"""
+# Most images one generate command may ask for
+MAX_IMAGES = 16
+# Rough activation memory per output pixel for one image in a denoising
+# pass (fp16; doubled for fp32 and again for classifier-free guidance)
+BYTES_PER_PIXEL = 1500
+
+def plan_images(prompt, negative_prompt="", num_images=None, seed=None):
+    """
+    Expand prompt/seed lists into one (prompt, negative_prompt, seed) per image
+    
+    prompt and negative_prompt may be strings or lists (a shorter negative
+    list is cycled). num_images is per prompt; when it is not given and seed
+    is a list, the seeds decide the count. An int seed gives consecutive
+    seeds, no seed gives random consecutive ones.
+    """
+    import random
+    prompts = prompt if isinstance(prompt, list) else [prompt]
+    negatives = negative_prompt if isinstance(negative_prompt, list) else [negative_prompt]
+    prompts = [p or "" for p in prompts] or [""]
+    negatives = [n or "" for n in negatives] or [""]
+    
+    if num_images is None:
+        num_images = max(1, len(seed) // len(prompts)) if isinstance(seed, list) else 1
+    num_images = int(num_images)
+    total = len(prompts) * num_images
+    if num_images < 1 or total > MAX_IMAGES:
+        raise ValueError(f"Between 1 and {MAX_IMAGES} images per request (asked for {total})")
+    
+    if isinstance(seed, list):
+        if len(seed) < total:
+            raise ValueError(f"{len(seed)} seeds given for {total} images")
+        seeds = [int(s) for s in seed[:total]]
+    else:
+        base = int(seed) if seed is not None else random.randint(0, 2**32 - 1 - total)
+        seeds = [base + i for i in range(total)]
+    
+    items = []
+    for i, p in enumerate(prompts):
+        for k in range(num_images):
+            index = i * num_images + k
+            items.append((p, negatives[i % len(negatives)], seeds[index]))
+    return items
+
+def max_batch_size(width, height, guidance):
+    """How many images fit in one diffusers call, from free GPU memory or RAM"""
+    import torch
+    per_image = width * height * BYTES_PER_PIXEL
+    if guidance and guidance > 1:
+        per_image *= 2  # Classifier-free guidance runs the UNet on two latents
+    try:
+        if pipeline.device.type == "cuda":
+            free, _ = torch.cuda.mem_get_info(pipeline.device)
+        else:
+            import psutil
+            free = psutil.virtual_memory().available
+            per_image *= 2  # fp32
+        # Keep a quarter of the free memory as headroom
+        return max(1, int(free * 0.75 // per_image))
+    except Exception:
+        return 1
+
+# Where "file" output writes images unless the command names a directory
+IMAGE_OUTPUT_DIR = os.path.join(tempfile.gettempdir(), "openmind-image-gen")
+
+# Encoded image formats: PIL format name, extension, MIME type
+IMAGE_FORMATS = {
+    "png": ("PNG", "png", "image/png"),
+    "webp": ("WEBP", "webp", "image/webp"),
+    "jpeg": ("JPEG", "jpg", "image/jpeg"),
+    "jpg": ("JPEG", "jpg", "image/jpeg")
+}
+
+def get_output_options(cmd):
+    """
+    Result transport and encoding options of a generate command
+    
+    output: "base64" (inline in the result message) or "file" (written to
+    output_dir, only the path is sent). format: png, webp or jpeg, with
+    compress_level (PNG, 0-9), quality (WebP/JPEG, 1-100) and lossless (WebP).
+    """
+    output = cmd.get("output", "base64")
+    if output not in ("base64", "file"):
+        raise ValueError(f"Unknown output mode: {output}")
+    image_format = str(cmd.get("format", "png")).lower()
+    if image_format not in IMAGE_FORMATS:
+        raise ValueError(f"Unknown image format: {image_format}")
+    return {
+        "output": output,
+        "format": image_format,
+        "compress_level": cmd.get("compress_level"),
+        "quality": cmd.get("quality"),
+        "lossless": bool(cmd.get("lossless", False)),
+        "output_dir": cmd.get("output_dir") or IMAGE_OUTPUT_DIR
+    }
+
+def save_options(options):
+    """PIL save() arguments for the chosen format"""
+    pil_format = IMAGE_FORMATS[options["format"]][0]
+    kwargs = {"format": pil_format}
+    if pil_format == "PNG" and options["compress_level"] is not None:
+        kwargs["compress_level"] = int(options["compress_level"])
+    elif pil_format == "WEBP":
+        kwargs["lossless"] = options["lossless"]
+        kwargs["quality"] = int(options["quality"] or 85)
+    elif pil_format == "JPEG":
+        kwargs["quality"] = int(options["quality"] or 90)
+    return kwargs
+
+def encode_image(image, prompt, seed, options=None, name="image"):
+    """
+    Result entry for one image: base64 data inline, or the path of the file
+    it was written to
+    """
+    options = options or get_output_options({})
+    _, ext, mime_type = IMAGE_FORMATS[options["format"]]
+    entry = {
+        "mime_type": mime_type,
+        "width": image.width,
+        "height": image.height,
+        "prompt": prompt,
+        "seed": seed
+    }
+    
+    if options["output"] == "file":
+        os.makedirs(options["output_dir"], exist_ok=True)
+        path = os.path.join(options["output_dir"], f"{name}.{ext}")
+        image.save(path, **save_options(options))
+        entry["path"] = path
+        entry["bytes"] = os.path.getsize(path)
+        return entry
+    
+    buffer = BytesIO()
+    image.save(buffer, **save_options(options))
+    entry["base64"] = base64.b64encode(buffer.getvalue()).decode('utf-8')
+    entry["bytes"] = buffer.tell()
+    return entry
+
+def clean_output_dir(max_age=24 * 3600):
+    """Remove result files the app never collected"""
+    try:
+        names = os.listdir(IMAGE_OUTPUT_DIR)
+    except OSError:
+        return
+    now = time.time()
+    for name in names:
+        path = os.path.join(IMAGE_OUTPUT_DIR, name)
+        try:
+            if now - os.path.getmtime(path) > max_age:
+                os.remove(path)
+        except OSError:
+            # E.g. still open elsewhere on Windows; try again next start
+            pass
+
+class StepProgress:
+    """
+    Per-step progress events (step, total, it/s, ETA) over every denoising
+    pass of one generate command, plus the cancel check at step boundaries
+    """
+    
+    def __init__(self, total_steps, cancel_event=None):
+        self.total = max(1, total_steps)
+        self.done = 0
+        self.cancel_event = cancel_event
+        self.start = None
+        self.last = None
+        self.durations = []  # Seconds each step took
+    
+    def begin(self):
+        """Start the clock (at each denoising pass, not at model setup)"""
+        self.last = time.perf_counter()
+        if self.start is None:
+            self.start = self.last
+    
+    def cancelled(self):
+        return self.cancel_event is not None and self.cancel_event.is_set()
+    
+    def step(self, raise_on_cancel=True):
+        if self.start is None:
+            self.begin()
+        now = time.perf_counter()
+        self.durations.append(now - self.last)
+        self.last = now
+        self.done = min(self.done + 1, self.total)
+        elapsed = now - self.start
+        its = self.done / elapsed if elapsed > 0 else None
+        send_response({
+            "type": "progress",
+            "message": f"Step {self.done}/{self.total}",
+            "progress": round(self.done / self.total, 4),
+            "step": self.done,
+            "total_steps": self.total,
+            "its": round(its, 2) if its else None,
+            "eta": round((self.total - self.done) / its, 1) if its else None
+        })
+        if raise_on_cancel and self.cancelled():
+            raise JobCancelled()
+    
+    def seconds_per_step(self):
+        """
+        Median step time; unlike the average it leaves out the one-off
+        first steps (prompt encoding, torch.compile)
+        """
+        if not self.durations:
+            return None
+        ordered = sorted(self.durations)
+        return round(ordered[len(ordered) // 2], 3)
+    
+    def diffusers_kwargs(self, pipe):
+        """Step callback arguments for a diffusers pipeline call"""
+        import inspect
+        params = inspect.signature(pipe.__call__).parameters
+        if "callback_on_step_end" in params:
+            def on_step_end(pipe, step, timestep, callback_kwargs):
+                self.step()
+                return callback_kwargs
+            return {"callback_on_step_end": on_step_end}
+        if "callback" in params:
+            # Older pipelines
+            return {"callback": lambda step, timestep, latents: self.step(), "callback_steps": 1}
+        return {}
+
+# Prompt embeddings kept across generate calls (0 disables the cache)
+PROMPT_CACHE_ENTRIES = int(os.environ.get("OPENMIND_IMAGE_PROMPT_CACHE", "32"))
+
+# What encode_prompt() returns, in order, for the pipelines it is used with
+# (2 tensors for SD 1.x/2.x, 4 with the pooled ones for SDXL and SD3)
+EMBEDDING_NAMES = ("prompt_embeds", "negative_prompt_embeds",
+                   "pooled_prompt_embeds", "negative_pooled_prompt_embeds")
+
+class PromptCache:
+    """
+    LRU of text-encoder outputs keyed by (model, prompt, negative prompt,
+    classifier-free guidance on/off), so regenerating with new seeds, sizes
+    or step counts skips the text encoders
+    """
+    
+    def __init__(self, max_entries=PROMPT_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, key):
+        """Cached embeddings tuple, or None on a miss"""
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            return None
+    
+    def put(self, key, embeddings):
+        with self.lock:
+            self.entries[key] = embeddings
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+    
+    def forget(self, model_key=None):
+        """Drop one model's entries (all entries when model_key is None)"""
+        with self.lock:
+            for key in [k for k in self.entries if model_key is None or k[0] == model_key]:
+                del self.entries[key]
+    
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                "entries": len(self.entries),
+                "max_entries": self.max_entries
+            }
+
+prompt_cache = PromptCache()
+
+def prompt_embedding_kwargs(batch, guidance):
+    """
+    Pipeline arguments for a batch's prompts: embeddings from prompt_cache
+    (encoding the misses) when the pipeline takes them, otherwise {} so
+    the caller passes the prompt strings
+    """
+    import inspect
+    import torch
+    encode = getattr(pipeline, "encode_prompt", None)
+    if prompt_cache.max_entries <= 0 or encode is None or (cpu_mode and cpu_mode["backend"] != "torch"):
+        return {}
+    encode_params = inspect.signature(encode).parameters
+    if "do_classifier_free_guidance" not in encode_params:
+        return {}  # Flux and other pipelines with a different encode_prompt
+    call_params = inspect.signature(pipeline.__call__).parameters
+    
+    do_cfg = bool(guidance and guidance > 1)
+    device = getattr(pipeline, "_execution_device", pipeline.device)
+    # Second/third text encoders (SDXL, SD3) get the same text, as they do
+    # when the pipeline encodes the prompt itself
+    extra = {name: None for name in ("prompt_2", "prompt_3", "negative_prompt_2", "negative_prompt_3")
+             if name in encode_params}
+    encoded = {}
+    for p, n, _ in batch:
+        key = (current_model, p, n, do_cfg)
+        if key in encoded:
+            continue
+        embeddings = prompt_cache.get(key)
+        if embeddings is None:
+            try:
+                with torch.no_grad():
+                    embeddings = tuple(encode(
+                        prompt=p,
+                        device=device,
+                        num_images_per_prompt=1,
+                        do_classifier_free_guidance=do_cfg,
+                        negative_prompt=n or None,
+                        **extra
+                    ))
+            except Exception as e:
+                send_progress(f"Prompt embedding cache skipped: {str(e)[:80]}")
+                return {}
+            if not all(name in call_params for name in EMBEDDING_NAMES[:len(embeddings)]):
+                return {}
+            prompt_cache.put(key, embeddings)
+        encoded[key] = embeddings
+    
+    per_image = [encoded[(current_model, p, n, do_cfg)] for p, n, _ in batch]
+    kwargs = {}
+    for i, name in enumerate(EMBEDDING_NAMES[:len(per_image[0])]):
+        tensors = [e[i] for e in per_image]
+        # Negative embeddings are None when guidance is off
+        kwargs[name] = None if tensors[0] is None else torch.cat(tensors)
+    return kwargs
+
+def generate_gguf(items, width, height, steps, guidance, cancel_event=None):
+    """
+    Generate with stable-diffusion-cpp. Runs of images with the same prompt
+    and consecutive seeds become one call with batch_count, since sd.cpp
+    seeds batch image i with seed + i.
+    
+    Returns:
+        ([(image, prompt, seed), ...], seconds per step)
+    """
+    runs = []
+    for item in items:
+        last = runs[-1] if runs else None
+        if last and last[0][:2] == item[:2] and last[-1][2] + 1 == item[2]:
+            last.append(item)
+        else:
+            runs.append([item])
+    
+    progress = StepProgress(steps * len(items), cancel_event)
+    
+    def on_step(step, total, seconds):
+        # Exceptions can't cross the C callback, so a cancel takes effect
+        # once sd.cpp returns; stop reporting progress meanwhile
+        if not progress.cancelled():
+            progress.step(raise_on_cancel=False)
+    
+    images = []
+    for run in runs:
+        if progress.cancelled():
+            raise JobCancelled()
+        prompt, negative_prompt, seed = run[0]
+        send_progress(f"Generating with GGUF model ({len(images) + 1}-{len(images) + len(run)} of {len(items)})...",
+                      len(images) / len(items))
+        progress.begin()
+        output = sd_cpp_model.generate_image(
+            prompt=prompt,
+            negative_prompt=negative_prompt,
+            width=width,
+            height=height,
+            sample_steps=steps,
+            cfg_scale=guidance,
+            seed=seed,
+            batch_count=len(run),
+            progress_callback=on_step
+        )
+        if output is None:
+            raise Exception("No image generated")
+        # Handle different return types
+        output = output if isinstance(output, list) else [output]
+        if not output:
+            raise Exception("No image generated")
+        images += [(image, p, s) for image, (p, _, s) in zip(output, run)]
+    return images, progress.seconds_per_step()
+
+def generate_diffusers(items, width, height, steps, guidance, cancel_event=None):
+    """
+    Generate with the diffusers pipeline, as few batched calls as memory allows
+    
+    Returns:
+        ([(image, prompt, seed), ...], seconds per step)
+    """
+    import torch
+    batch_size = min(len(items), max_batch_size(width, height, guidance))
+    batches = range(0, len(items), batch_size)
+    progress = StepProgress(steps * len(batches), cancel_event)
+    step_kwargs = progress.diffusers_kwargs(pipeline)
+    # Exported (OpenVINO / ONNX Runtime) pipelines take CPU generators
+    generator_device = "cpu" if cpu_mode else pipeline.device
+    autocast = cpu_mode is not None and cpu_mode["autocast"]
+    
+    images = []
+    for start in batches:
+        if progress.cancelled():
+            raise JobCancelled()
+        batch = items[start:start + batch_size]
+        if len(items) > 1:
+            send_progress(f"Generating images {start + 1}-{start + len(batch)} of {len(items)}...",
+                          start / len(items))
+        
+        negatives = [n for _, n, _ in batch]
+        with torch.autocast("cpu", dtype=torch.bfloat16) if autocast else nullcontext():
+            prompt_kwargs = prompt_embedding_kwargs(batch, guidance)
+            if not prompt_kwargs:
+                prompt_kwargs = {
+                    "prompt": [p for p, _, _ in batch],
+                    "negative_prompt": negatives if any(negatives) else None
+                }
+            progress.begin()
+            result = pipeline(
+                **prompt_kwargs,
+                width=width,
+                height=height,
+                num_inference_steps=steps,
+                guidance_scale=guidance,
+                # One generator per image so every image is reproducible from its seed
+                generator=[torch.Generator(device=generator_device).manual_seed(s) for _, _, s in batch],
+                **step_kwargs
+            )
+        images += [(image, p, s) for image, (p, _, s) in zip(result.images, batch)]
+    return images, progress.seconds_per_step()
+
+def generate_image(prompt, negative_prompt="", width=512, height=512, steps=20, guidance=7.5, seed=None,
+                   num_images=None, output=None, cancel_event=None):
+    """
+    Generate one or more images
+    
+    prompt, negative_prompt and seed may be lists (see plan_images). All
+    images are sent back in one result message, encoded as `output`
+    (see get_output_options) says.
+    """
     global pipeline, sd_cpp_model, model_type
     
     if pipeline is None and sd_cpp_model is None:
@@ -377,74 +1429,42 @@ def generate_image(prompt, negative_prompt="", width=512, height=512, steps=20,
         return
     
     try:
-        send_progress("Generating image...", 0)
+        items = plan_images(prompt, negative_prompt, num_images, seed)
+        models.touch()
+        started = time.perf_counter()
+        send_progress("Generating image..." if len(items) == 1 else f"Generating {len(items)} images...", 0)
         
         # Use GGUF model if loaded
         if model_type == 'gguf' and sd_cpp_model is not None:
-            # Generate with stable-diffusion-cpp
-            import random
-            actual_seed = seed if seed is not None else random.randint(0, 2**32 - 1)
-            
-            send_progress("Generating with GGUF model...")
-            
-            # Use generate_image method
-            images = sd_cpp_model.generate_image(
-                prompt=prompt,
-                negative_prompt=negative_prompt or "",
-                width=width,
-                height=height,
-                sample_steps=steps,
-                cfg_scale=guidance,
-                seed=actual_seed
-            )
-            
-            if images is None:
-                raise Exception("No image generated")
-            
-            # Handle different return types
-            if isinstance(images, list):
-                image = images[0]
-            else:
-                image = images
-            
+            images, seconds_per_step = generate_gguf(items, width, height, steps, guidance, cancel_event)
         else:
-            # Use Diffusers pipeline
-            import torch
-            
-            # Set seed for reproducibility
-            generator = None
-            if seed is not None:
-                generator = torch.Generator(device=pipeline.device).manual_seed(seed)
-            
-            # Generate
-            result = pipeline(
-                prompt=prompt,
-                negative_prompt=negative_prompt if negative_prompt else None,
-                width=width,
-                height=height,
-                num_inference_steps=steps,
-                guidance_scale=guidance,
-                generator=generator
-            )
-            
-            image = result.images[0]
+            images, seconds_per_step = generate_diffusers(items, width, height, steps, guidance, cancel_event)
+        models.record_speed(seconds_per_step)
+        timing = {
+            "seconds_per_step": seconds_per_step,
+            "total_seconds": round(time.perf_counter() - started, 2)
+        }
         
-        # Convert to base64
-        buffer = BytesIO()
-        image.save(buffer, format="PNG")
-        base64_image = base64.b64encode(buffer.getvalue()).decode('utf-8')
+        if cancel_event is not None and cancel_event.is_set():
+            raise JobCancelled()
         
+        job = getattr(job_context, 'job', None)
+        job_name = "".join(c if c.isalnum() or c in "-_" else "_" for c in job.id) if job else "image"
+        prefix = f"{job_name}-{int(time.time() * 1000)}"
+        results = [
+            encode_image(image, p, s, output, f"{prefix}-{i}")
+            for i, (image, p, s) in enumerate(images)
+        ]
         send_response({
             "type": "result",
             "success": True,
-            "image": {
-                "base64": base64_image,
-                "dataUrl": f"data:image/png;base64,{base64_image}",
-                "width": image.width,
-                "height": image.height
-            }
+            "images": results,
+            "timing": timing,
+            "cpu_mode": cpu_mode
         })
         
+    except JobCancelled:
+        raise
     except Exception as e:
         send_response({"type": "error", "error": f"Generation failed: {str(e)}"})
 
@@ -481,6 +1501,188 @@ def check_dependencies():
     
     return missing, optional_missing
 
+class JobCancelled(Exception):
+    """Raised inside a job that was cancelled while running"""
+    pass
+
+class Job:
+    """A queued load/generate/unload command"""
+    
+    def __init__(self, job_id, cmd, priority, seq):
+        self.id = job_id
+        self.cmd = cmd
+        self.action = cmd.get("action")
+        self.priority = priority
+        self.seq = seq
+        self.state = "queued"
+        self.created = time.time()
+        self.started = None
+        self.cancel_event = threading.Event()
+    
+    def info(self):
+        return {
+            "job_id": self.id,
+            "action": self.action,
+            "state": self.state,
+            "priority": self.priority,
+            "prompt": self.cmd.get("prompt"),
+            "waited": round((self.started or time.time()) - self.created, 2),
+            "running_for": round(time.time() - self.started, 2) if self.started else None
+        }
+
+class JobQueue:
+    """
+    Commands that touch the model run one at a time on a worker thread,
+    highest priority first, then in arrival order. Queued jobs can be
+    cancelled or reprioritized; a running job is asked to stop via its
+    cancel_event.
+    """
+    
+    def __init__(self):
+        self.queued = []
+        self.running = None
+        self.closed = False
+        self.cond = threading.Condition()
+        self.seq = itertools.count(1)
+    
+    def submit(self, cmd):
+        """Queue a command and return (job, position in the queue)"""
+        with self.cond:
+            seq = next(self.seq)
+            job = Job(str(cmd.get("id") or f"job-{seq}"), cmd, int(cmd.get("priority", 0)), seq)
+            self.queued.append(job)
+            self.cond.notify()
+            return job, self._order().index(job)
+    
+    def _order(self):
+        """Queued jobs in the order they will run (lock held)"""
+        return sorted(self.queued, key=lambda j: (-j.priority, j.seq))
+    
+    def next(self):
+        """Block until a job is available and mark it running (None once closed)"""
+        with self.cond:
+            while not self.queued and not self.closed:
+                self.cond.wait()
+            if self.closed:
+                return None
+            job = self._order()[0]
+            self.queued.remove(job)
+            job.state = "running"
+            job.started = time.time()
+            self.running = job
+            return job
+    
+    def finish(self, job):
+        with self.cond:
+            if self.running is job:
+                self.running = None
+    
+    def find(self, job_id):
+        """Queued or running job by id (lock held)"""
+        if self.running is not None and self.running.id == job_id:
+            return self.running
+        for job in self.queued:
+            if job.id == job_id:
+                return job
+        return None
+    
+    def cancel(self, job_id):
+        """
+        Cancel a job
+        
+        Returns:
+            "cancelled" if it was still queued, "cancelling" if it is
+            running and will stop, "not_found" otherwise
+        """
+        with self.cond:
+            job = self.find(job_id)
+            if job is None:
+                return "not_found"
+            job.cancel_event.set()
+            if job is self.running:
+                return "cancelling"
+            self.queued.remove(job)
+            job.state = "cancelled"
+            return "cancelled"
+    
+    def set_priority(self, job_id, priority):
+        """Change a queued job's priority; returns its new position or None"""
+        with self.cond:
+            job = self.find(job_id)
+            if job is None or job is self.running:
+                return None
+            job.priority = priority
+            return self._order().index(job)
+    
+    def list(self):
+        with self.cond:
+            running = [self.running.info()] if self.running else []
+            return running + [job.info() for job in self._order()]
+    
+    def close(self):
+        """Cancel everything and stop the worker"""
+        with self.cond:
+            self.closed = True
+            if self.running is not None:
+                self.running.cancel_event.set()
+            self.queued.clear()
+            self.cond.notify_all()
+
+jobs = JobQueue()
+
+def run_command(cmd, cancel_event):
+    """Run a load/generate/unload command (on the worker thread)"""
+    action = cmd.get("action")
+    
+    if action == "load":
+        model_id = cmd.get("model", "stabilityai/sdxl-turbo")
+        local_path = cmd.get("local_path")  # Optional local path
+        success = load_model(model_id, local_path, cmd.get("cpu"))
+        if success:
+            send_response({"type": "loaded", "model": model_id, "local_path": local_path, "cpu_mode": cpu_mode})
+            
+    elif action == "generate":
+        generate_image(
+            prompt=cmd.get("prompt", ""),
+            negative_prompt=cmd.get("negative_prompt", ""),
+            width=cmd.get("width", 512),
+            height=cmd.get("height", 512),
+            steps=cmd.get("steps", 20),
+            guidance=cmd.get("guidance", 7.5),
+            seed=cmd.get("seed"),
+            num_images=cmd.get("num_images"),
+            output=get_output_options(cmd),
+            cancel_event=cancel_event
+        )
+        
+    elif action == "unload":
+        # One model (local path or model id), or all of them
+        target = cmd.get("local_path") or cmd.get("model")
+        models.remove(target)
+        send_response({"type": "unloaded", "model": target})
+
+def worker_loop():
+    """Run queued jobs one after another"""
+    while True:
+        job = jobs.next()
+        if job is None:
+            return
+        job_context.job = job
+        try:
+            if job.cancel_event.is_set():
+                raise JobCancelled()
+            run_command(job.cmd, job.cancel_event)
+        except JobCancelled:
+            send_response({"type": "cancelled"})
+        except Exception as e:
+            send_response({"type": "error", "error": str(e)})
+        finally:
+            job_context.job = None
+            jobs.finish(job)
+
+# Commands that are queued as jobs; everything else is answered right away
+JOB_ACTIONS = ("load", "generate", "unload")
+
 def main():
     """Main loop - read JSON commands from stdin"""
     
@@ -507,47 +1709,43 @@ def main():
         "gpu_info": gpu_info
     })
     
+    clean_output_dir()
+    worker = threading.Thread(target=worker_loop, name="image-gen-worker", daemon=True)
+    worker.start()
+    
     for line in sys.stdin:
         try:
             cmd = json.loads(line.strip())
             action = cmd.get("action")
+            # Replies to immediate commands echo the command's id
+            reply = {"job_id": cmd["id"]} if cmd.get("id") is not None else {}
             
-            if action == "load":
-                model_id = cmd.get("model", "stabilityai/sdxl-turbo")
-                local_path = cmd.get("local_path")  # Optional local path
-                success = load_model(model_id, local_path)
-                if success:
-                    send_response({"type": "loaded", "model": model_id, "local_path": local_path})
-                    
-            elif action == "generate":
-                generate_image(
-                    prompt=cmd.get("prompt", ""),
-                    negative_prompt=cmd.get("negative_prompt", ""),
-                    width=cmd.get("width", 512),
-                    height=cmd.get("height", 512),
-                    steps=cmd.get("steps", 20),
-                    guidance=cmd.get("guidance", 7.5),
-                    seed=cmd.get("seed")
-                )
+            if action in JOB_ACTIONS:
+                job, position = jobs.submit(cmd)
+                send_response({"type": "queued", "job_id": job.id, "action": action, "position": position})
                 
-            elif action == "unload":
-                global pipeline, sd_cpp_model, current_model, model_type
-                pipeline = None
-                sd_cpp_model = None
-                current_model = None
-                model_type = None
-                try:
-                    import torch
-                    if torch.cuda.is_available():
-                        torch.cuda.empty_cache()
-                except:
-                    pass
-                send_response({"type": "unloaded"})
+            elif action == "cancel":
+                target = str(cmd.get("job_id"))
+                state = jobs.cancel(target)
+                send_response({**reply, "type": "cancel", "target": target, "state": state})
+                if state == "cancelled":
+                    # Queued jobs never reach the worker, so end them here
+                    send_response({"type": "cancelled", "job_id": target})
+                
+            elif action == "set_priority":
+                target = str(cmd.get("job_id"))
+                position = jobs.set_priority(target, int(cmd.get("priority", 0)))
+                send_response({**reply, "type": "priority", "target": target, "position": position})
+                
+            elif action == "list_jobs":
+                send_response({**reply, "type": "jobs", "jobs": jobs.list()})
                 
             elif action == "status":
                 cuda_available, gpu_info = check_cuda_available()
                 sd_cpp_cuda, sd_cpp_info = check_sd_cpp_cuda()
+                job_list = jobs.list()
                 send_response({
+                    **reply,
                     "type": "status",
                     "model_loaded": current_model is not None,
                     "current_model": current_model,
@@ -555,7 +1753,11 @@ def main():
                     "cuda_available": cuda_available,
                     "gpu_info": gpu_info,
                     "sd_cpp_cuda": sd_cpp_cuda,
-                    "sd_cpp_info": sd_cpp_info
+                    "sd_cpp_info": sd_cpp_info,
+                    "running_job": next((j for j in job_list if j["state"] == "running"), None),
+                    "queued_jobs": sum(1 for j in job_list if j["state"] == "queued"),
+                    "prompt_cache": prompt_cache.stats(),
+                    **models.status()
                 })
                 
             elif action == "quit":
@@ -565,6 +1767,8 @@ def main():
             send_response({"type": "error", "error": "Invalid JSON"})
         except Exception as e:
             send_response({"type": "error", "error": str(e)})
+    
+    jobs.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
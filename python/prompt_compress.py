@@ -7,12 +7,23 @@ Uses Microsoft's LLMLingua to compress prompts for smaller LLMs
 import sys
 import json
 import argparse
+import hashlib
+import math
 import os
+import re
+import threading
+import time
+from collections import OrderedDict
 from pathlib import Path
 
 # Set model cache directory to local models folder
 SCRIPT_DIR = Path(__file__).parent.parent
 MODELS_CACHE = SCRIPT_DIR / "models" / "llmlingua"
+COMPRESSED_CACHE = MODELS_CACHE / "compressed"
+CONVERSATIONS_DIR = MODELS_CACHE / "conversations"
+ONNX_DIR = MODELS_CACHE / "onnx"
+
+MODEL_NAME = "microsoft/llmlingua-2-bert-base-multilingual-cased-meetingbank"
 
 # Set HuggingFace cache environment variables
 os.environ['HF_HOME'] = str(MODELS_CACHE)
@@ -20,21 +31,506 @@ os.environ['TRANSFORMERS_CACHE'] = str(MODELS_CACHE)
 
 # Lazy load to avoid slow startup
 llm_lingua = None
+load_time_ms = None  # How long the last successful compressor load took
+load_timing = {}  # Breakdown of the last load: import_ms, model_ms, backend_ms
+
+# Classifier backend: "torch", "onnx" or "onnx-int8" (falls back to torch)
+BACKENDS = ["torch", "onnx", "onnx-int8"]
+backend = os.environ.get("OPENMIND_LLMLINGUA_BACKEND", "torch")
+active_backend = None
+keep_torch_model = False  # Keep the PyTorch model around for backend comparison
+torch_model = None
+
+# Sample used by --mode check to compare backends
+CHECK_SAMPLE = (
+    "Item 15, report from City Manager. Recommendation to adopt three resolutions. "
+    "First, to join the Victoria Transit Authority as a member agency; second, to "
+    "approve the 2024 budget of 1.2 million dollars for the downtown shuttle; and "
+    "third, to direct staff to return within 90 days with a plan for evening service. "
+    "Councilmember Price asked whether the shuttle would serve the hospital district, "
+    "and staff confirmed that two of the five proposed stops are within walking distance."
+)
+
+# Chunks per classifier forward pass when compressing several messages at once
+DEFAULT_BATCH_SIZE = 16
+
+# Default bound for the in-memory compression cache
+DEFAULT_CACHE_ENTRIES = 2048
+
+# Conversations whose compressed history is kept in memory
+MAX_CONVERSATIONS = 64
+
+# Long-input mode: classifier tokens per chunk (the model sees at most 512)
+DEFAULT_CHUNK_TOKENS = 400
+
+# Budget mode: never compress a message below this ratio, and round planned
+# ratios to this step so repeated turns keep hitting the cache
+MIN_BUDGET_RATIO = 0.3
+BUDGET_RATIO_STEP = 0.05
+
+def send_response(data):
+    """Send JSON response to stdout"""
+    print(json.dumps(data), flush=True)
+
+class CompressionCache:
+    """
+    Content-addressed cache of compressed texts
+    
+    Entries are keyed by hash(content, rate, force_tokens, model name) and kept
+    in an in-memory LRU. With a disk directory, every entry is also written
+    there as a small JSON file so later processes start warm.
+    """
+    
+    def __init__(self, max_entries=DEFAULT_CACHE_ENTRIES, max_bytes=None, disk_dir=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+        self.entries = OrderedDict()
+        self.size_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+        self.disk_entries = None  # {path: size}, scanned on first write
+    
+    @staticmethod
+    def make_key(content, rate, force_tokens=None):
+        """Hash everything that affects the compressed output"""
+        # torch, onnx and onnx-int8 can keep different tokens. Before the
+        # model is loaded this is the requested backend, which it falls back
+        # from only when ONNX is unavailable.
+        payload = json.dumps([content, rate, force_tokens or [], MODEL_NAME, active_backend or backend],
+                             ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    
+    def _disk_path(self, key):
+        return self.disk_dir / key[:2] / f"{key}.json"
+    
+    def _over_limit(self, count, size):
+        if self.max_entries is not None and count > self.max_entries:
+            return True
+        return self.max_bytes is not None and size > self.max_bytes
+    
+    def _too_big(self, value):
+        """A value that alone exceeds max_bytes would evict everything else"""
+        return self.max_bytes is not None and len(value.encode("utf-8")) > self.max_bytes
+    
+    def _store(self, key, value):
+        """Insert into the memory tier and evict LRU entries (lock held)"""
+        if self._too_big(value):
+            return
+        if key in self.entries:
+            self.size_bytes -= len(self.entries.pop(key).encode("utf-8"))
+        self.entries[key] = value
+        self.size_bytes += len(value.encode("utf-8"))
+        while self.entries and self._over_limit(len(self.entries), self.size_bytes):
+            _, evicted = self.entries.popitem(last=False)
+            self.size_bytes -= len(evicted.encode("utf-8"))
+            self.evictions += 1
+    
+    def get(self, key):
+        """Return the cached compressed text, or None on a miss"""
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            
+            if self.disk_dir:
+                path = self._disk_path(key)
+                try:
+                    with open(path, "r", encoding="utf-8") as f:
+                        value = json.load(f)["compressed"]
+                    os.utime(path)  # Keep disk eviction roughly LRU
+                    self._store(key, value)
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return value
+                except (OSError, ValueError, KeyError):
+                    pass
+            
+            self.misses += 1
+            return None
+    
+    def put(self, key, value):
+        """Cache a compressed text in memory (and on disk if enabled)"""
+        if self._too_big(value):
+            return
+        with self.lock:
+            self._store(key, value)
+            if self.disk_dir:
+                self._write_disk(key, value)
+    
+    def _write_disk(self, key, value):
+        """Write one entry to the disk tier and prune it to the same bounds (lock held)"""
+        try:
+            if self.disk_entries is None:
+                self.disk_entries = {}
+                if self.disk_dir.exists():
+                    for path in self.disk_dir.glob("*/*.json"):
+                        self.disk_entries[path] = path.stat().st_size
+            
+            path = self._disk_path(key)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix(".tmp")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"compressed": value}, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+            self.disk_entries[path] = path.stat().st_size
+            
+            if self._over_limit(len(self.disk_entries), sum(self.disk_entries.values())):
+                def mtime(p):
+                    try:
+                        return p.stat().st_mtime
+                    except OSError:
+                        return 0
+                total = sum(self.disk_entries.values())
+                for old_path in sorted(self.disk_entries, key=mtime):
+                    if not self._over_limit(len(self.disk_entries), total):
+                        break
+                    total -= self.disk_entries.pop(old_path)
+                    try:
+                        old_path.unlink()
+                    except OSError:
+                        pass
+                    self.disk_evictions += 1
+        except OSError as e:
+            print(json.dumps({"error": f"Compression cache write failed: {str(e)}"}), file=sys.stderr)
+    
+    def stats(self):
+        """Counters for the response JSON"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "disk_evictions": self.disk_evictions,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                "entries": len(self.entries),
+                "bytes": self.size_bytes,
+                "disk": str(self.disk_dir) if self.disk_dir else None
+            }
+
+# Process-wide compression cache (configured from the command line in main())
+cache = CompressionCache()
+
+def configure_cache(max_entries=DEFAULT_CACHE_ENTRIES, max_bytes=None, disk=False):
+    """Replace the compression cache; max_entries=0 disables caching"""
+    global cache
+    if max_entries == 0:
+        cache = None
+    else:
+        cache = CompressionCache(
+            max_entries=max_entries,
+            max_bytes=max_bytes,
+            disk_dir=COMPRESSED_CACHE if disk else None
+        )
+    return cache
+
+def configure_conversations(disk=False):
+    """Replace the conversation store, optionally persisting it on disk"""
+    global conversations
+    conversations = ConversationStore(disk_dir=CONVERSATIONS_DIR if disk else None)
+    return conversations
+
+def cache_stats():
+    """Cache counters, or None when caching is disabled"""
+    return cache.stats() if cache else None
+
+class ConversationStore:
+    """
+    Compressed history per conversation id
+    
+    Each state holds the compressed messages so far, how many original
+    messages they cover and the ratio they were compressed with. The least
+    recently used conversations are dropped from memory; with a disk
+    directory they are reloaded from there on the next turn.
+    """
+    
+    def __init__(self, max_conversations=MAX_CONVERSATIONS, disk_dir=None):
+        self.max_conversations = max_conversations
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+        self.states = OrderedDict()
+        self.lock = threading.Lock()
+    
+    def _disk_path(self, conversation_id):
+        name = hashlib.sha256(str(conversation_id).encode("utf-8")).hexdigest()[:32]
+        return self.disk_dir / f"{name}.json"
+    
+    def get(self, conversation_id):
+        """Return the stored state, or None for an unknown conversation"""
+        with self.lock:
+            if conversation_id in self.states:
+                self.states.move_to_end(conversation_id)
+                return self.states[conversation_id]
+        
+        if self.disk_dir:
+            try:
+                with open(self._disk_path(conversation_id), "r", encoding="utf-8") as f:
+                    state = json.load(f)
+                self._remember(conversation_id, state)
+                return state
+            except (OSError, ValueError):
+                pass
+        return None
+    
+    def _remember(self, conversation_id, state):
+        with self.lock:
+            self.states[conversation_id] = state
+            self.states.move_to_end(conversation_id)
+            while len(self.states) > self.max_conversations:
+                self.states.popitem(last=False)
+    
+    def save(self, conversation_id, state):
+        """Store a conversation's state in memory (and on disk if enabled)"""
+        self._remember(conversation_id, state)
+        if self.disk_dir:
+            try:
+                self.disk_dir.mkdir(parents=True, exist_ok=True)
+                path = self._disk_path(conversation_id)
+                tmp_path = path.with_suffix(".tmp")
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(state, f, ensure_ascii=False)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                print(json.dumps({"error": f"Conversation save failed: {str(e)}"}), file=sys.stderr)
+    
+    def forget(self, conversation_id):
+        """Drop a conversation's state"""
+        with self.lock:
+            self.states.pop(conversation_id, None)
+        if self.disk_dir:
+            try:
+                self._disk_path(conversation_id).unlink()
+            except OSError:
+                pass
+
+# Process-wide conversation state (disk persistence follows --cache-disk)
+conversations = ConversationStore()
+
+class OnnxTokenClassifier:
+    """
+    Stands in for the PromptCompressor's PyTorch model and runs the
+    LLMLingua-2 classifier through onnxruntime instead. LLMLingua only calls
+    model(input_ids=..., attention_mask=...) and reads .logits.
+    """
+    
+    def __init__(self, session, config=None):
+        self.session = session
+        self.config = config
+    
+    def eval(self):
+        return self
+    
+    def __call__(self, input_ids, attention_mask):
+        import torch
+        from types import SimpleNamespace
+        logits = self.session.run(["logits"], {
+            "input_ids": input_ids.cpu().numpy().astype("int64"),
+            "attention_mask": attention_mask.cpu().numpy().astype("int64")
+        })[0]
+        return SimpleNamespace(loss=None, logits=torch.from_numpy(logits))
+
+def export_onnx(compressor, quantize=False):
+    """
+    Export the classifier to ONNX once (optionally int8-quantized) under ONNX_DIR
+    
+    Returns:
+        Path of the ONNX file to load
+    """
+    import torch
+    
+    name = MODEL_NAME.split("/")[-1]
+    fp32_path = ONNX_DIR / f"{name}.onnx"
+    int8_path = ONNX_DIR / f"{name}-int8.onnx"
+    ONNX_DIR.mkdir(parents=True, exist_ok=True)
+    
+    if not fp32_path.exists():
+        model = compressor.model
+        
+        class LogitsOnly(torch.nn.Module):
+            def __init__(self):
+                super().__init__()
+                self.model = model
+            
+            def forward(self, input_ids, attention_mask):
+                return self.model(input_ids=input_ids, attention_mask=attention_mask).logits
+        
+        dummy = compressor.tokenizer("Export sample text.", return_tensors="pt")
+        tmp_path = fp32_path.with_suffix(".tmp")
+        with torch.no_grad():
+            torch.onnx.export(
+                LogitsOnly().eval(),
+                (dummy["input_ids"], dummy["attention_mask"]),
+                str(tmp_path),
+                input_names=["input_ids", "attention_mask"],
+                output_names=["logits"],
+                dynamic_axes={
+                    "input_ids": {0: "batch", 1: "sequence"},
+                    "attention_mask": {0: "batch", 1: "sequence"},
+                    "logits": {0: "batch", 1: "sequence"}
+                },
+                opset_version=14
+            )
+        os.replace(tmp_path, fp32_path)
+        print(json.dumps({"status": "exported", "path": str(fp32_path)}), file=sys.stderr)
+    
+    if not quantize:
+        return fp32_path
+    
+    if not int8_path.exists():
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        tmp_path = int8_path.with_suffix(".tmp")
+        quantize_dynamic(str(fp32_path), str(tmp_path), weight_type=QuantType.QInt8)
+        os.replace(tmp_path, int8_path)
+        print(json.dumps({"status": "quantized", "path": str(int8_path)}), file=sys.stderr)
+    return int8_path
+
+def enable_onnx_backend(compressor, quantize=False):
+    """Swap the compressor's PyTorch model for an onnxruntime session"""
+    global torch_model
+    import onnxruntime as ort
+    
+    path = export_onnx(compressor, quantize)
+    session = ort.InferenceSession(str(path), providers=["CPUExecutionProvider"])
+    if keep_torch_model:
+        torch_model = compressor.model
+    compressor.model = OnnxTokenClassifier(session, getattr(compressor.model, "config", None))
+
+def configure_backend(name):
+    """Select the classifier backend (also picked up by worker processes)"""
+    global backend
+    backend = name
+    os.environ["OPENMIND_LLMLINGUA_BACKEND"] = name
+
+def compare_backends(runs=3):
+    """
+    Compare the active ONNX backend against PyTorch on CHECK_SAMPLE
+    
+    Returns:
+        Dict with word keep/drop agreement and median latencies, or None
+        if no ONNX backend is active
+    """
+    compressor = get_compressor()
+    if compressor is None or active_backend == "torch" or torch_model is None:
+        return None
+    
+    word_sep = "\t\t|\t\t"
+    label_sep = " "
+    onnx_model = compressor.model
+    labels = {}
+    latency = {}
+    try:
+        for name, model in (("torch", torch_model), (active_backend, onnx_model)):
+            compressor.model = model
+            times = []
+            for _ in range(runs):
+                start = time.perf_counter()
+                result = compressor.compress_prompt(
+                    CHECK_SAMPLE,
+                    rate=0.5,
+                    drop_consecutive=True,
+                    return_word_label=True,
+                    word_sep=word_sep,
+                    label_sep=label_sep
+                )
+                times.append((time.perf_counter() - start) * 1000)
+            labels[name] = [w.rsplit(label_sep, 1)[-1] for w in result["fn_labeled_original_prompt"].split(word_sep)]
+            latency[name] = round(sorted(times)[len(times) // 2], 1)
+    finally:
+        compressor.model = onnx_model
+    
+    reference = labels["torch"]
+    candidate = labels[active_backend]
+    matches = sum(1 for a, b in zip(reference, candidate) if a == b)
+    return {
+        "backend": active_backend,
+        "words": len(reference),
+        "agreement": round(matches / max(len(reference), len(candidate), 1), 4),
+        "torch_ms": latency["torch"],
+        "onnx_ms": latency[active_backend],
+        "speedup": round(latency["torch"] / latency[active_backend], 2) if latency[active_backend] else None
+    }
+
+def find_cached_model():
+    """
+    Find the classifier weights in the local HuggingFace cache without
+    importing transformers
+    
+    Returns:
+        Path of the snapshot directory, or None if not downloaded yet
+    """
+    repo_dir = "models--" + MODEL_NAME.replace("/", "--")
+    for root in (MODELS_CACHE, MODELS_CACHE / "hub"):
+        snapshots = root / repo_dir / "snapshots"
+        if not snapshots.is_dir():
+            continue
+        for snapshot in snapshots.iterdir():
+            has_config = (snapshot / "config.json").exists()
+            has_weights = (snapshot / "model.safetensors").exists() or (snapshot / "pytorch_model.bin").exists()
+            if has_config and has_weights:
+                return snapshot
+    return None
+
+def quick_check():
+    """
+    Cheap availability probe: looks for the packages and cached weights
+    without importing torch or building the compressor
+    """
+    import importlib.util
+    start = time.perf_counter()
+    
+    required = ["llmlingua", "transformers", "torch"]
+    if backend in ("onnx", "onnx-int8"):
+        optional = ["onnx", "onnxruntime"]
+    else:
+        optional = []
+    packages = {name: importlib.util.find_spec(name) is not None for name in required + optional}
+    snapshot = find_cached_model()
+    
+    return {
+        "available": all(packages[name] for name in required),
+        "packages": packages,
+        "model_cached": snapshot is not None,
+        "backend": backend,
+        "check_ms": round((time.perf_counter() - start) * 1000, 1)
+    }
 
 def get_compressor():
     """Lazy load the LLMLingua compressor"""
-    global llm_lingua
+    global llm_lingua, load_time_ms, load_timing, active_backend
     if llm_lingua is None:
         try:
+            start = time.perf_counter()
             from llmlingua import PromptCompressor
+            imported = time.perf_counter()
             # Use a small, fast model for compression
             # Model will be loaded from local cache if available
             llm_lingua = PromptCompressor(
-                model_name="microsoft/llmlingua-2-bert-base-multilingual-cased-meetingbank",
+                model_name=MODEL_NAME,
                 use_llmlingua2=True,
                 device_map="cpu"  # Use CPU for compatibility
             )
-            print(json.dumps({"status": "loaded", "model": "llmlingua-2", "cache": str(MODELS_CACHE)}), file=sys.stderr)
+            loaded = time.perf_counter()
+            active_backend = "torch"
+            if backend in ("onnx", "onnx-int8"):
+                try:
+                    enable_onnx_backend(llm_lingua, quantize=backend == "onnx-int8")
+                    active_backend = backend
+                except Exception as e:
+                    print(json.dumps({"error": f"ONNX backend unavailable, using PyTorch: {str(e)}"}), file=sys.stderr)
+            end = time.perf_counter()
+            load_time_ms = round((end - start) * 1000, 1)
+            load_timing = {
+                "import_ms": round((imported - start) * 1000, 1),
+                "model_ms": round((loaded - imported) * 1000, 1),
+                "backend_ms": round((end - loaded) * 1000, 1)
+            }
+            print(json.dumps({"status": "loaded", "model": "llmlingua-2", "backend": active_backend, "cache": str(MODELS_CACHE)}), file=sys.stderr)
         except ImportError:
             print(json.dumps({"error": "LLMLingua not installed. Run: pip install llmlingua"}), file=sys.stderr)
             return None
@@ -55,6 +551,13 @@ def compress_prompt(text, target_ratio=0.5, force_tokens=None):
     Returns:
         Compressed text
     """
+    key = None
+    if cache:
+        key = cache.make_key(text, target_ratio, force_tokens)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+    
     compressor = get_compressor()
     if compressor is None:
         return text  # Return original if compression fails
@@ -66,72 +569,699 @@ def compress_prompt(text, target_ratio=0.5, force_tokens=None):
             force_tokens=force_tokens or [],
             drop_consecutive=True
         )
-        return result.get("compressed_prompt", text)
+        compressed = result.get("compressed_prompt", text)
+        if key:
+            cache.put(key, compressed)
+        return compressed
     except Exception as e:
         print(json.dumps({"error": f"Compression failed: {str(e)}"}), file=sys.stderr)
         return text
 
-def compress_messages(messages, target_ratio=0.6):
+def should_compress_message(msg):
+    """Don't compress system prompts or very short messages"""
+    return msg.get("role", "user") != "system" and len(msg.get("content", "")) >= 100
+
+def count_tokens(compressor, texts):
+    """Count classifier tokens across texts (used for throughput stats)"""
+    try:
+        return sum(len(compressor.tokenizer.tokenize(t)) for t in texts)
+    except Exception:
+        return None
+
+def compress_batch(compressor, texts, target_ratio, force_tokens=None, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Compress several texts with one pass of the LLMLingua-2 token classifier
+    
+    Every text is chunked and thresholded exactly like a standalone
+    compress_prompt() call, but all chunks go through the model together in
+    padded batches of `batch_size`.
+    
+    Args:
+        compressor: Loaded PromptCompressor
+        texts: List of texts to compress
+        target_ratio: Target compression ratio
+        force_tokens: List of tokens to keep
+        batch_size: Chunks per forward pass
+    
+    Returns:
+        List of compressed texts, or None if the installed llmlingua
+        doesn't expose the LLMLingua-2 internals
+    """
+    # PromptCompressor keeps these private (name-mangled); bail out to the
+    # per-message path if a different llmlingua version renamed them
+    chunk_context = getattr(compressor, "_PromptCompressor__chunk_context", None)
+    compress = getattr(compressor, "_PromptCompressor__compress", None)
+    if chunk_context is None or compress is None or not getattr(compressor, "use_llmlingua2", False):
+        return None
+    
+    # Same force-token and chunk-boundary handling as compress_prompt_llmlingua2()
+    force_tokens = force_tokens or []
+    token_map = {}
+    for i, token in enumerate(force_tokens):
+        if len(compressor.tokenizer.tokenize(token)) != 1:
+            token_map[token] = compressor.added_tokens[i]
+    chunk_end_tokens = [".", "\n"]
+    chunk_end_tokens += [token_map[c] for c in chunk_end_tokens if c in token_map]
+    chunk_end_tokens = set(chunk_end_tokens)
+    
+    contexts = []
+    for text in texts:
+        for original, replacement in token_map.items():
+            text = text.replace(original, replacement)
+        contexts.append(chunk_context(text, chunk_end_tokens=chunk_end_tokens))
+    
+    previous_batch_size = compressor.max_batch_size
+    compressor.max_batch_size = batch_size
+    try:
+        compressed, _, _ = compress(
+            contexts,
+            reduce_rate=max(0, 1 - target_ratio),
+            token_to_word="mean",
+            force_tokens=force_tokens,
+            token_map=token_map,
+            force_reserve_digit=False,
+            drop_consecutive=True
+        )
+    finally:
+        compressor.max_batch_size = previous_batch_size
+    
+    return compressed
+
+def compress_messages(messages, target_ratio=0.6, batch_size=DEFAULT_BATCH_SIZE, stats=None):
     """
     Compress a list of chat messages
     
     Args:
         messages: List of {role, content} message dicts
         target_ratio: Target compression ratio
+        batch_size: Chunks per classifier forward pass (1 = one call per message)
+        stats: Optional dict that gets filled with throughput stats
     
     Returns:
         List of compressed messages
     """
+    start = time.perf_counter()
+    compressed = list(messages)
+    eligible = [i for i, msg in enumerate(messages) if should_compress_message(msg)]
+    
+    # Serve repeated history messages from the cache
+    pending = []
+    for i in eligible:
+        content = messages[i].get("content", "")
+        key = cache.make_key(content, target_ratio) if cache else None
+        cached = cache.get(key) if key else None
+        if cached is not None:
+            compressed[i] = {"role": messages[i].get("role", "user"), "content": cached}
+        else:
+            pending.append((i, content, key))
+    
+    texts = [content for _, content, _ in pending]
+    compressor = get_compressor() if texts else None
+    if texts and compressor is None:
+        return compressed
+    
+    results = None
+    if texts and batch_size and batch_size > 1:
+        try:
+            results = compress_batch(compressor, texts, target_ratio, batch_size=batch_size)
+        except Exception as e:
+            print(json.dumps({"error": f"Batched compression failed: {str(e)}"}), file=sys.stderr)
+    batched = results is not None
+    
+    # Per-message path
+    if results is None:
+        results = []
+        for text in texts:
+            try:
+                result = compressor.compress_prompt(
+                    text,
+                    rate=target_ratio,
+                    drop_consecutive=True
+                )
+                results.append(result.get("compressed_prompt", text))
+            except:
+                results.append(None)
+    
+    for (i, _, key), content in zip(pending, results):
+        if content is not None:
+            compressed[i] = {
+                "role": messages[i].get("role", "user"),
+                "content": content
+            }
+            if key:
+                cache.put(key, content)
+    
+    if stats is not None:
+        elapsed = time.perf_counter() - start
+        input_tokens = count_tokens(compressor, texts) if compressor else 0
+        stats.update({
+            "messages": len(messages),
+            "compressed": len(eligible),
+            "cached": len(eligible) - len(pending),
+            "batched": batched,
+            "batch_size": batch_size if batched else 1,
+            "input_tokens": input_tokens,
+            "elapsed_ms": round(elapsed * 1000, 1),
+            "tokens_per_sec": round(input_tokens / elapsed, 1) if input_tokens and elapsed > 0 else None
+        })
+    
+    return compressed
+
+def compress_conversation(conversation_id, new_messages, target_ratio=0.6, offset=None,
+                          reset=False, batch_size=DEFAULT_BATCH_SIZE, stats=None):
+    """
+    Compress only the newly appended messages of a conversation
+    
+    The compressed history from earlier calls is kept per conversation id,
+    so each turn only pays for its own new content.
+    
+    Args:
+        conversation_id: Caller-chosen id of the conversation
+        new_messages: Messages appended since the last call
+        target_ratio: Target compression ratio
+        offset: Index of the first new message in the full history. Defaults
+            to the stored length; a smaller value replaces the tail (e.g. a
+            regenerated reply)
+        reset: Discard any stored state before appending
+        batch_size: Chunks per classifier forward pass
+        stats: Optional dict that gets filled with throughput stats
+    
+    Returns:
+        Full compressed history, or None if the caller is out of sync and
+        has to re-send the whole conversation with reset=True
+    """
+    state = None if reset else conversations.get(conversation_id)
+    if state is not None and state.get("ratio") != target_ratio:
+        # Older turns were compressed with another ratio; only a full re-send fits
+        if offset != 0:
+            return None
+        state = None
+    if state is None:
+        state = {"ratio": target_ratio, "length": 0, "messages": []}
+    
+    if offset is None:
+        offset = state["length"]
+    if offset > state["length"]:
+        return None
+    
+    compressed_new = compress_messages(new_messages, target_ratio, batch_size=batch_size, stats=stats)
+    
+    state = {
+        "ratio": target_ratio,
+        "length": offset + len(new_messages),
+        "messages": state["messages"][:offset] + compressed_new
+    }
+    conversations.save(conversation_id, state)
+    
+    if stats is not None:
+        stats["history_length"] = state["length"]
+        stats["new_messages"] = len(new_messages)
+    return state["messages"]
+
+def estimate_tokens(text):
+    """Rough token count without a tokenizer (~4 characters per token)"""
+    return (len(text) + 3) // 4
+
+def split_into_chunks(text, max_tokens=DEFAULT_CHUNK_TOKENS, count=estimate_tokens):
+    """
+    Split text into chunks of at most max_tokens
+    
+    Splits on paragraphs first, then sentences, then words, and packs the
+    pieces back together. Every piece keeps its surrounding whitespace, so
+    "".join(chunks) == text.
+    
+    Args:
+        text: Text to split
+        max_tokens: Upper bound on tokens per chunk
+        count: Function returning the token count of a string
+    
+    Returns:
+        List of chunk strings
+    """
+    def pieces(part, level):
+        if count(part) <= max_tokens or level == 3:
+            return [part]
+        if level == 0:
+            parts = re.split(r"(?<=\n\n)", part)
+        elif level == 1:
+            parts = re.split(r"(?<=[.!?])(?=\s)", part)
+        else:
+            parts = re.split(r"(?<=\s)(?=\S)", part)
+        parts = [p for p in parts if p]
+        if len(parts) <= 1:
+            return pieces(part, level + 1)
+        return [piece for p in parts for piece in pieces(p, level + 1)]
+    
+    chunks = []
+    current = ""
+    current_tokens = 0
+    for piece in pieces(text, 0):
+        piece_tokens = count(piece)
+        if current and current_tokens + piece_tokens > max_tokens:
+            chunks.append(current)
+            current = ""
+            current_tokens = 0
+        current += piece
+        current_tokens += piece_tokens
+    if current:
+        chunks.append(current)
+    return chunks
+
+def _compress_chunk(chunk, target_ratio, force_tokens=None):
+    """Compress one chunk and time it (runs in pool workers too)"""
+    start = time.perf_counter()
     compressor = get_compressor()
     if compressor is None:
-        return messages
+        return chunk, round((time.perf_counter() - start) * 1000, 1)
+    result = compressor.compress_prompt(
+        chunk,
+        rate=target_ratio,
+        force_tokens=force_tokens or [],
+        drop_consecutive=True
+    )
+    return result.get("compressed_prompt", chunk), round((time.perf_counter() - start) * 1000, 1)
+
+# Worker processes for long-input mode, created on first use and reused.
+# Every worker loads its own copy of the model (roughly 0.7 GB of RAM for
+# MODEL_NAME on the torch backend) next to the one in this process, so the
+# count is capped.
+MAX_CHUNK_WORKERS = int(os.environ.get("OPENMIND_LLMLINGUA_MAX_WORKERS", "4"))
+chunk_pool = None
+chunk_pool_workers = 0
+
+def get_chunk_pool(workers):
+    """Return a process pool with `workers` processes, each loading its own compressor"""
+    global chunk_pool, chunk_pool_workers
+    if chunk_pool is None or chunk_pool_workers != workers:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        if chunk_pool is not None:
+            chunk_pool.shutdown()
+        # Spawn, not fork: this process already runs torch (and its thread
+        # pools), which forked children can deadlock on
+        chunk_pool = ProcessPoolExecutor(max_workers=workers, initializer=get_compressor,
+                                         mp_context=multiprocessing.get_context("spawn"))
+        chunk_pool_workers = workers
+    return chunk_pool
+
+def compress_long_text(text, target_ratio=0.5, force_tokens=None,
+                       chunk_tokens=DEFAULT_CHUNK_TOKENS, workers=1, stats=None):
+    """
+    Compress a long document chunk by chunk
+    
+    The text is split on paragraph/sentence boundaries into chunks that fit
+    the classifier, each chunk is compressed at target_ratio (so the whole
+    text is too) and the results are stitched back together in order.
     
-    compressed = []
-    for msg in messages:
-        role = msg.get("role", "user")
-        content = msg.get("content", "")
+    Args:
+        text: The text to compress
+        target_ratio: Target compression ratio for the whole text
+        force_tokens: List of tokens to keep
+        chunk_tokens: Max classifier tokens per chunk
+        workers: Worker processes (1 = compress in this process), at most
+            MAX_CHUNK_WORKERS
+        stats: Optional dict that gets filled with per-chunk latencies
+    
+    Returns:
+        Compressed text
+    """
+    start = time.perf_counter()
+    workers = max(1, min(workers, MAX_CHUNK_WORKERS))
+    compressor = get_compressor()
+    if compressor is not None:
+        count = lambda t: len(compressor.tokenizer.tokenize(t))
+    else:
+        count = estimate_tokens
+    
+    chunks = split_into_chunks(text, chunk_tokens, count)
+    results = [None] * len(chunks)
+    latencies = [0.0] * len(chunks)
+    
+    pending = []
+    for i, chunk in enumerate(chunks):
+        key = cache.make_key(chunk, target_ratio, force_tokens) if cache else None
+        cached = cache.get(key) if key else None
+        if cached is not None:
+            results[i] = cached
+        else:
+            pending.append((i, key))
+    
+    if pending and compressor is not None:
+        if workers > 1 and len(pending) > 1:
+            try:
+                pool = get_chunk_pool(workers)
+                jobs = [(i, key, pool.submit(_compress_chunk, chunks[i], target_ratio, force_tokens).result)
+                        for i, key in pending]
+            except Exception as e:
+                print(json.dumps({"error": f"Compression failed: {str(e)}"}), file=sys.stderr)
+                jobs = []
+        else:
+            jobs = [(i, key, lambda i=i: _compress_chunk(chunks[i], target_ratio, force_tokens))
+                    for i, key in pending]
         
-        # Don't compress system prompts or very short messages
-        if role == "system" or len(content) < 100:
-            compressed.append(msg)
-            continue
+        # A failed chunk stays uncompressed; the others keep their results
+        done = []
+        for i, key, job in jobs:
+            try:
+                done.append((i, key, job()))
+            except Exception as e:
+                print(json.dumps({"error": f"Compression failed for chunk {i}: {str(e)}"}), file=sys.stderr)
         
-        # Compress longer messages
-        try:
-            result = compressor.compress_prompt(
-                content,
-                rate=target_ratio,
-                drop_consecutive=True
-            )
-            compressed_content = result.get("compressed_prompt", content)
-            compressed.append({
-                "role": role,
-                "content": compressed_content
-            })
-        except:
-            compressed.append(msg)
+        for i, key, (compressed, ms) in done:
+            results[i] = compressed
+            latencies[i] = ms
+            if key:
+                cache.put(key, compressed)
+    
+    # Stitch in order, keeping paragraph breaks between chunks
+    parts = []
+    for i, chunk in enumerate(chunks):
+        compressed = (chunk if results[i] is None else results[i]).strip()
+        if not compressed:
+            continue
+        if parts:
+            parts.append("\n\n" if re.search(r"\n\s*\n\s*$", chunks[i - 1]) else " ")
+        parts.append(compressed)
+    output = "".join(parts)
+    
+    if stats is not None:
+        input_tokens = count(text) if chunks else 0
+        output_tokens = count(output) if output else 0
+        compressed_now = {i for i, _ in pending}
+        stats.update({
+            "chunks": [
+                {"index": i, "tokens": count(chunk), "ms": latencies[i],
+                 "cached": i not in compressed_now}
+                for i, chunk in enumerate(chunks)
+            ],
+            "workers": workers,
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "achieved_ratio": round(output_tokens / input_tokens, 3) if input_tokens else None,
+            "requested_ratio": target_ratio,
+            "elapsed_ms": round((time.perf_counter() - start) * 1000, 1)
+        })
+    
+    return output
+
+def fit_messages_to_budget(messages, budget_tokens, min_ratio=MIN_BUDGET_RATIO,
+                           batch_size=DEFAULT_BATCH_SIZE, stats=None):
+    """
+    Compress chat messages just enough to fit a token budget
+    
+    Token counts are estimated without loading the model. If the history
+    already fits, nothing is compressed. Otherwise older and longer messages
+    are compressed first, each only as far as needed to close the gap.
+    
+    Args:
+        messages: List of {role, content} message dicts
+        budget_tokens: Token budget for the whole history (e.g. the model's context size)
+        min_ratio: Lowest ratio any single message is compressed to
+        batch_size: Chunks per classifier forward pass
+        stats: Optional dict that gets filled with the plan and estimates
+    
+    Returns:
+        List of (possibly) compressed messages
+    """
+    tokens = [estimate_tokens(msg.get("content", "")) for msg in messages]
+    total = sum(tokens)
+    excess = total - budget_tokens
+    
+    # Plan a ratio per message, oldest and longest first
+    plan = {}
+    if excess > 0:
+        n = len(messages)
+        candidates = [i for i, msg in enumerate(messages) if should_compress_message(msg)]
+        candidates.sort(key=lambda i: tokens[i] * (1 + (n - 1 - i) / max(1, n - 1)), reverse=True)
+        for i in candidates:
+            # excess is a token count; anything under one is float residue
+            if excess < 1:
+                break
+            savable = tokens[i] * (1 - min_ratio)
+            if savable >= excess:
+                ratio = 1 - excess / tokens[i]
+                # The epsilon keeps e.g. 0.35 / 0.05 = 6.999... from flooring to 6
+                ratio = max(min_ratio, math.floor(ratio / BUDGET_RATIO_STEP + 1e-9) * BUDGET_RATIO_STEP)
+            else:
+                ratio = min_ratio
+            ratio = round(ratio, 2)
+            if ratio >= 1:
+                continue  # Would run the compressor for nothing
+            plan[i] = ratio
+            excess -= tokens[i] * (1 - ratio)
+    
+    compressed = list(messages)
+    for ratio in sorted(set(plan.values())):
+        indices = [i for i, r in plan.items() if r == ratio]
+        results = compress_messages([messages[i] for i in indices], ratio, batch_size=batch_size)
+        for i, msg in zip(indices, results):
+            compressed[i] = msg
+    
+    if stats is not None:
+        estimated_after = sum(estimate_tokens(msg.get("content", "")) for msg in compressed)
+        stats.update({
+            "budget_tokens": budget_tokens,
+            "estimated_tokens": total,
+            "estimated_tokens_after": estimated_after,
+            "fits": estimated_after <= budget_tokens,
+            "skipped": not plan,
+            "plan": [{"index": i, "ratio": r} for i, r in sorted(plan.items())]
+        })
     
     return compressed
 
+def prefetch():
+    """
+    Download the classifier into MODELS_CACHE (and export the ONNX backend
+    if selected), then run one warm-up compression
+    
+    Returns:
+        Dict with import/model-load/warm-up timings
+    """
+    cached_before = find_cached_model() is not None
+    compressor = get_compressor()
+    if compressor is None:
+        return {"prefetched": False, "model_cached_before": cached_before}
+    
+    start = time.perf_counter()
+    compressor.compress_prompt(CHECK_SAMPLE, rate=0.5, drop_consecutive=True)
+    warmup_ms = round((time.perf_counter() - start) * 1000, 1)
+    
+    return {
+        "prefetched": True,
+        "model_cached_before": cached_before,
+        "backend": active_backend,
+        "cache": str(MODELS_CACHE),
+        "load_ms": load_time_ms,
+        **load_timing,
+        "warmup_ms": warmup_ms
+    }
+
+def handle_request(cmd, default_ratio=0.5, default_batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Run a single serve-mode request
+    
+    Args:
+        cmd: Request dict with "action" and its payload
+        default_ratio: Ratio used when the request doesn't specify one
+        default_batch_size: Batch size used when the request doesn't specify one
+    
+    Returns:
+        Response dict (without id/timing)
+    """
+    action = cmd.get("action", "text")
+    ratio = cmd.get("ratio", default_ratio)
+    
+    if action == "check":
+        return {"type": "check", "available": get_compressor() is not None, "load_timing": load_timing}
+    
+    if action == "text":
+        text = cmd.get("text", cmd.get("input", ""))
+        if not isinstance(text, str):
+            return {"type": "error", "error": "text must be a string"}
+        result = compress_prompt(text, ratio, cmd.get("force_tokens"))
+        return {"type": "result", "result": result, "cache": cache_stats()}
+    
+    if action == "messages":
+        messages = cmd.get("messages", cmd.get("input", []))
+        if not isinstance(messages, list):
+            return {"type": "error", "error": "messages must be a list"}
+        stats = {}
+        budget = cmd.get("budget")
+        if budget is not None:
+            if isinstance(budget, bool) or not isinstance(budget, int) or budget <= 0:
+                return {"type": "error", "error": "budget must be a positive integer"}
+            result = fit_messages_to_budget(
+                messages,
+                budget,
+                min_ratio=cmd.get("min_ratio", MIN_BUDGET_RATIO),
+                batch_size=cmd.get("batch_size", default_batch_size),
+                stats=stats
+            )
+        else:
+            result = compress_messages(
+                messages,
+                cmd.get("ratio", 0.6),
+                batch_size=cmd.get("batch_size", default_batch_size),
+                stats=stats
+            )
+        return {"type": "result", "result": result, "stats": stats, "cache": cache_stats()}
+    
+    if action == "conversation":
+        conversation_id = cmd.get("conversation_id")
+        messages = cmd.get("messages", cmd.get("input", []))
+        if conversation_id is None:
+            return {"type": "error", "error": "conversation_id is required"}
+        if not isinstance(messages, list):
+            return {"type": "error", "error": "messages must be a list"}
+        stats = {}
+        result = compress_conversation(
+            conversation_id,
+            messages,
+            cmd.get("ratio", 0.6),
+            offset=cmd.get("offset"),
+            reset=cmd.get("reset", False),
+            batch_size=cmd.get("batch_size", default_batch_size),
+            stats=stats
+        )
+        if result is None:
+            return {"type": "error", "error": "Conversation out of sync, re-send it with reset", "resync": True}
+        return {"type": "result", "result": result, "stats": stats, "cache": cache_stats()}
+    
+    if action == "long":
+        text = cmd.get("text", cmd.get("input", ""))
+        if not isinstance(text, str):
+            return {"type": "error", "error": "text must be a string"}
+        stats = {}
+        result = compress_long_text(
+            text,
+            ratio,
+            cmd.get("force_tokens"),
+            chunk_tokens=cmd.get("chunk_tokens", DEFAULT_CHUNK_TOKENS),
+            workers=cmd.get("workers", 1),
+            stats=stats
+        )
+        return {"type": "result", "result": result, "stats": stats, "cache": cache_stats()}
+    
+    if action == "forget":
+        conversations.forget(cmd.get("conversation_id"))
+        return {"type": "forgotten", "conversation_id": cmd.get("conversation_id")}
+    
+    return {"type": "error", "error": f"Unknown action: {action}"}
+
+def serve(default_ratio=0.5, default_batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Long-lived mode: read newline-delimited JSON requests from stdin and
+    answer each one on stdout, keyed by the request's "id".
+    The compressor is loaded once up front and kept warm between requests.
+    """
+    compressor = get_compressor()
+    send_response({
+        "type": "ready",
+        "available": compressor is not None,
+        "backend": active_backend,
+        "load_ms": load_time_ms,
+        "load_timing": load_timing
+    })
+    
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        
+        try:
+            cmd = json.loads(line)
+        except json.JSONDecodeError:
+            send_response({"type": "error", "error": "Invalid JSON"})
+            continue
+        
+        if not isinstance(cmd, dict):
+            send_response({"type": "error", "error": "Request must be a JSON object"})
+            continue
+        
+        if cmd.get("action") == "quit":
+            break
+        
+        start = time.perf_counter()
+        try:
+            response = handle_request(cmd, default_ratio, default_batch_size)
+        except Exception as e:
+            response = {"type": "error", "error": str(e)}
+        
+        response["id"] = cmd.get("id")
+        response["timing"] = {
+            "load_ms": load_time_ms,
+            "request_ms": round((time.perf_counter() - start) * 1000, 1)
+        }
+        send_response(response)
+
 def main():
     parser = argparse.ArgumentParser(description="LLMLingua Prompt Compression")
-    parser.add_argument("--mode", choices=["text", "messages", "check"], default="text",
+    parser.add_argument("--mode", choices=["text", "messages", "conversation", "long", "check", "prefetch", "serve"], default="text",
                        help="Compression mode")
     parser.add_argument("--ratio", type=float, default=0.5,
                        help="Target compression ratio (0.5 = 50%)")
     parser.add_argument("--input", type=str, help="Input text or JSON file")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                       help="Chunks per classifier pass in messages mode (1 = per-message)")
+    parser.add_argument("--verify", action="store_true",
+                       help="In check mode, load the model (and compare ONNX vs PyTorch) instead of the quick probe")
+    parser.add_argument("--backend", choices=BACKENDS, default=backend,
+                       help="Classifier backend (onnx/onnx-int8 export once to models/llmlingua/onnx)")
+    parser.add_argument("--budget", type=int, default=None,
+                       help="Token budget in messages mode; compresses only as much as needed")
+    parser.add_argument("--cache-entries", type=int, default=DEFAULT_CACHE_ENTRIES,
+                       help="Max cached compressions (0 disables the cache)")
+    parser.add_argument("--cache-bytes", type=int, default=None,
+                       help="Max size of cached compressed text in bytes")
+    parser.add_argument("--cache-disk", action="store_true",
+                       help=f"Also persist the cache and conversation state under {MODELS_CACHE}")
+    parser.add_argument("--conversation-id", type=str,
+                       help="Conversation id for conversation mode")
+    parser.add_argument("--offset", type=int, default=None,
+                       help="Index of the first new message in conversation mode")
+    parser.add_argument("--chunk-tokens", type=int, default=DEFAULT_CHUNK_TOKENS,
+                       help="Max classifier tokens per chunk in long mode")
+    parser.add_argument("--workers", type=int, default=1,
+                       help="Worker processes for long mode (each loads its own model; "
+                            "capped by OPENMIND_LLMLINGUA_MAX_WORKERS)")
+    parser.add_argument("--reset", action="store_true",
+                       help="Discard stored conversation state before appending")
     
     args = parser.parse_args()
+    configure_backend(args.backend)
+    configure_cache(args.cache_entries, args.cache_bytes, args.cache_disk)
+    configure_conversations(args.cache_disk)
+    
+    if args.mode == "check" and not args.verify:
+        print(json.dumps(quick_check()))
+        return
     
     if args.mode == "check":
-        # Just check if LLMLingua is available
+        # Load the model for real (and see how the ONNX backend compares)
+        global keep_torch_model
+        keep_torch_model = True
         compressor = get_compressor()
         if compressor:
-            print(json.dumps({"available": True}))
+            print(json.dumps({
+                "available": True,
+                "backend": active_backend,
+                "load_ms": load_time_ms,
+                **load_timing,
+                "comparison": compare_backends()
+            }))
         else:
             print(json.dumps({"available": False}))
         return
     
+    if args.mode == "prefetch":
+        print(json.dumps(prefetch()))
+        return
+    
+    if args.mode == "serve":
+        serve(args.ratio, args.batch_size)
+        return
+    
     # Read input
     if args.input:
         if args.input.endswith(".json"):
@@ -148,8 +1278,32 @@ def main():
             pass  # Keep as string
     
     # Compress
+    stats = None
     if args.mode == "messages" and isinstance(data, list):
-        result = compress_messages(data, args.ratio)
+        stats = {}
+        if args.budget is not None:
+            result = fit_messages_to_budget(data, args.budget, batch_size=args.batch_size, stats=stats)
+        else:
+            result = compress_messages(data, args.ratio, batch_size=args.batch_size, stats=stats)
+    elif args.mode == "conversation" and isinstance(data, list):
+        if not args.conversation_id:
+            print(json.dumps({"error": "--conversation-id is required"}))
+            sys.exit(1)
+        stats = {}
+        result = compress_conversation(
+            args.conversation_id, data, args.ratio,
+            offset=args.offset, reset=args.reset,
+            batch_size=args.batch_size, stats=stats
+        )
+        if result is None:
+            print(json.dumps({"error": "Conversation out of sync, re-send it with --reset", "resync": True}))
+            sys.exit(1)
+    elif args.mode == "long" and isinstance(data, str):
+        stats = {}
+        result = compress_long_text(
+            data, args.ratio,
+            chunk_tokens=args.chunk_tokens, workers=args.workers, stats=stats
+        )
     else:
         if isinstance(data, str):
             result = compress_prompt(data, args.ratio)
@@ -157,7 +1311,12 @@ def main():
             result = data
     
     # Output
-    print(json.dumps({"result": result}))
+    output = {"result": result}
+    if stats:
+        output["stats"] = stats
+    if cache:
+        output["cache"] = cache_stats()
+    print(json.dumps(output))
 
 if __name__ == "__main__":
     main()
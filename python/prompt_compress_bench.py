@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+Benchmark for OpenMind prompt compression
+Measures cold start, latency, throughput, memory, ratio fidelity and cache
+hit rate of prompt_compress.py and writes the results as JSON
+"""
+
+import sys
+import json
+import argparse
+import math
+import os
+import platform
+import random
+import time
+from pathlib import Path
+
+import prompt_compress as pc
+
+# Synthetic chat history sizes (number of messages)
+DEFAULT_LENGTHS = [4, 16, 64]
+
+WORDS = (
+    "the model should summarize meeting notes budget project deadline team review "
+    "customer feedback release plan server latency memory cache request response "
+    "python electron image prompt context token history user assistant question "
+    "answer because however therefore meanwhile although quickly carefully report "
+    "agenda proposal estimate priority risk issue fix test deploy monitor metric"
+).split()
+
+def synthetic_history(length, seed=0):
+    """Build a deterministic chat history of `length` messages"""
+    rng = random.Random(seed)
+    messages = [{"role": "system", "content": "You are a helpful assistant."}]
+    for i in range(length):
+        sentences = []
+        for _ in range(rng.randint(2, 12)):
+            words = [rng.choice(WORDS) for _ in range(rng.randint(6, 20))]
+            sentences.append(" ".join(words).capitalize() + ".")
+        messages.append({
+            "role": "user" if i % 2 == 0 else "assistant",
+            "content": " ".join(sentences)
+        })
+    return messages
+
+def load_recorded(path):
+    """
+    Load recorded histories from a JSON file: either a list of histories or
+    a {name: history} dict, where a history is a list of {role, content}
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        return list(data.items())
+    if data and isinstance(data[0], dict):
+        data = [data]
+    return [(f"recorded-{i}", history) for i, history in enumerate(data)]
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB, if the platform reports it"""
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports KB, macOS bytes
+        return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+    except ImportError:
+        pass
+    try:
+        import psutil
+        info = psutil.Process().memory_info()
+        return round(getattr(info, "peak_wset", info.rss) / (1024 * 1024), 1)
+    except ImportError:
+        return None
+
+def percentile(values, p):
+    """Nearest-rank percentile"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1))
+    return round(ordered[index], 1)
+
+def count_tokens(compressor, text):
+    if compressor is not None:
+        return len(compressor.tokenizer.tokenize(text))
+    return pc.estimate_tokens(text)
+
+def bench_history(name, history, ratio, runs, batch_size):
+    """Compress one history `runs` times with the cache disabled"""
+    compressor = pc.get_compressor()
+    eligible = [m["content"] for m in history if pc.should_compress_message(m)]
+    input_tokens = sum(count_tokens(compressor, t) for t in eligible)
+
+    saved_cache = pc.cache
+    pc.cache = None
+    latencies = []
+    result = history
+    try:
+        for _ in range(runs):
+            start = time.perf_counter()
+            result = pc.compress_messages(history, ratio, batch_size=batch_size)
+            latencies.append((time.perf_counter() - start) * 1000)
+    finally:
+        pc.cache = saved_cache
+
+    output_tokens = sum(
+        count_tokens(compressor, result[i]["content"])
+        for i, m in enumerate(history) if pc.should_compress_message(m)
+    )
+    mean_s = sum(latencies) / len(latencies) / 1000 if latencies else 0
+
+    return {
+        "name": name,
+        "messages": len(history),
+        "compressed_messages": len(eligible),
+        "input_tokens": input_tokens,
+        "runs": runs,
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "tokens_per_sec": round(input_tokens / mean_s, 1) if mean_s else None,
+        "requested_ratio": ratio,
+        "achieved_ratio": round(output_tokens / input_tokens, 3) if input_tokens else None
+    }
+
+def bench_replay(history, ratio, batch_size):
+    """
+    Replay a chat turn by turn, re-sending the whole history each time like
+    the app does, and report how much the compression cache absorbs
+    """
+    saved_cache = pc.cache
+    pc.cache = pc.CompressionCache()
+    latencies = []
+    try:
+        for turn in range(2, len(history) + 1):
+            start = time.perf_counter()
+            pc.compress_messages(history[:turn], ratio, batch_size=batch_size)
+            latencies.append((time.perf_counter() - start) * 1000)
+        stats = pc.cache.stats()
+    finally:
+        pc.cache = saved_cache
+
+    return {
+        "turns": len(latencies),
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "cache_hit_rate": stats["hit_rate"],
+        "cache_hits": stats["hits"],
+        "cache_misses": stats["misses"]
+    }
+
+def run_benchmark(lengths=None, recorded=None, ratio=0.5, runs=5, batch_size=pc.DEFAULT_BATCH_SIZE, seed=0):
+    """
+    Run the full benchmark
+
+    Args:
+        lengths: Synthetic history sizes to run
+        recorded: Optional path to recorded histories (JSON)
+        ratio: Requested compression ratio
+        runs: Timed runs per history
+        batch_size: Chunks per classifier forward pass
+        seed: Seed for synthetic histories
+
+    Returns:
+        Results dict (JSON-serializable)
+    """
+    started = time.perf_counter()
+    compressor = pc.get_compressor()
+    cold_start_ms = round((time.perf_counter() - started) * 1000, 1)
+
+    histories = [(f"synthetic-{n}", synthetic_history(n, seed)) for n in (lengths or DEFAULT_LENGTHS)]
+    if recorded:
+        histories += load_recorded(recorded)
+
+    try:
+        from importlib.metadata import version
+        llmlingua_version = version("llmlingua")
+    except Exception:
+        llmlingua_version = None
+
+    results = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "machine": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "cpu_count": os.cpu_count()
+        },
+        "llmlingua": llmlingua_version,
+        "available": compressor is not None,
+        "backend": pc.active_backend,
+        "batch_size": batch_size,
+        "cold_start": {"total_ms": cold_start_ms, **pc.load_timing},
+        "histories": [],
+        "replay": None,
+        "peak_rss_mb": None
+    }
+
+    if compressor is None:
+        results["peak_rss_mb"] = peak_rss_mb()
+        return results
+
+    # Warm up once so the first timed run doesn't pay for lazy initialization
+    pc.compress_prompt(pc.CHECK_SAMPLE, ratio)
+
+    for name, history in histories:
+        results["histories"].append(bench_history(name, history, ratio, runs, batch_size))
+
+    longest = max(histories, key=lambda h: len(h[1]))[1]
+    results["replay"] = bench_replay(longest, ratio, batch_size)
+    results["peak_rss_mb"] = peak_rss_mb()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Prompt compression benchmark")
+    parser.add_argument("--lengths", type=int, nargs="+", default=DEFAULT_LENGTHS,
+                       help="Synthetic history sizes (messages)")
+    parser.add_argument("--recorded", type=str,
+                       help="JSON file with recorded chat histories")
+    parser.add_argument("--ratio", type=float, default=0.5,
+                       help="Requested compression ratio")
+    parser.add_argument("--runs", type=int, default=5,
+                       help="Timed runs per history")
+    parser.add_argument("--batch-size", type=int, default=pc.DEFAULT_BATCH_SIZE,
+                       help="Chunks per classifier pass (1 = per-message)")
+    parser.add_argument("--backend", choices=pc.BACKENDS, default=pc.backend,
+                       help="Classifier backend")
+    parser.add_argument("--seed", type=int, default=0,
+                       help="Seed for synthetic histories")
+    parser.add_argument("--output", type=str,
+                       help="Write results to this JSON file as well as stdout")
+
+    args = parser.parse_args()
+    pc.configure_backend(args.backend)
+
+    results = run_benchmark(
+        lengths=args.lengths,
+        recorded=args.recorded,
+        ratio=args.ratio,
+        runs=args.runs,
+        batch_size=args.batch_size,
+        seed=args.seed
+    )
+
+    if args.output:
+        Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    print(json.dumps(results))
+
+if __name__ == "__main__":
+    main()